@@ -0,0 +1,386 @@
+"""Benchmarks for the auto-parser and both services
+
+Every case runs in its own interpreter so peak RSS and module state are
+not shared between cases. Results are written as JSON and can be compared
+with the results of another commit:
+
+    python3 benchmarks/bench.py --output new.json --compare old.json
+"""
+import argparse
+import inspect
+import io
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List
+
+_REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(_REPO_ROOT, "src"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import datagen  # noqa: E402
+import standins  # noqa: E402
+
+# Metrics compared between runs, True if higher is better
+_METRICS = {
+    "invoices_per_sec": True,
+    "p50_ms": False,
+    "p99_ms": False,
+    "peak_rss_kb": False,
+    "import_ms": False
+}
+
+# Modules whose import time is measured, service_cron is imported by every cron run
+_STARTUP_MODULES = ("service_cron", "service_parse", "service_zip")
+
+
+def _cases(quick: bool) -> List[str]:
+    position_counts = (1, 10, 100) if quick else (1, 10, 100, 1000, 10000)
+    cases = []
+    for positions in position_counts:
+        cases.append(f"autoparser.render:{positions}")
+        cases.append(f"autoparser.parse_text+parse_xml:{positions}")
+        cases.append(f"autoparser.render_stream:{positions}")
+    cases.append("autoparser.render_escaped:100")
+    invoices = 20 if quick else 200
+    for mode in ("sequential", "pipeline", "async"):
+        cases.append(f"service_parse.{mode}:{invoices}")
+    for mode in ("sequential", "async"):
+        cases.append(f"service_zip.{mode}:{invoices}")
+    repeats = 5 if quick else 20
+    for module in _STARTUP_MODULES:
+        cases.append(f"startup.import_{module}:{repeats}")
+    for service in ("parse", "zip"):
+        cases.append(f"startup.idle_{service}:{repeats}")
+    return cases
+
+
+def _result(latencies: List[float], count: int, seconds: float, failed: int = 0) -> Dict[str, float]:
+    latencies = sorted(latencies)
+    return {
+        "count": count,
+        "failed": failed,
+        "seconds": round(seconds, 4),
+        "invoices_per_sec": round(count / seconds, 2) if seconds else None,
+        "p50_ms": round(statistics.median(latencies) * 1000, 3) if latencies else None,
+        "p99_ms": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000, 3) if latencies else None,
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    }
+
+
+def _timed(function: Callable, latencies: List[float]) -> Callable:
+    """Wrap a function or coroutine function to record its run time"""
+    if inspect.iscoroutinefunction(function):
+        async def timed_async(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await function(*args, **kwargs)
+            finally:
+                latencies.append(time.perf_counter() - start)
+        return timed_async
+
+    def timed(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - start)
+    return timed
+
+
+def _bench_autoparser(name: str, positions: int) -> Dict[str, float]:
+    os.chdir(_REPO_ROOT)
+    import autoparser
+
+    content = datagen.generate_invoice(
+        1, positions, escape_ratio=0.2 if name == "autoparser.render_escaped" else 0.0)
+    if name == "autoparser.parse_text+parse_xml":
+        def run():
+            autoparser.parse_text(content)
+            autoparser.parse_xml(content)
+    elif name == "autoparser.render_stream":
+        def run():
+            for file_format in ("txt", "xml"):
+                _, chunks = autoparser.render_stream(io.StringIO(content.decode("utf-8")), file_format)
+                for _ in chunks:
+                    pass
+    else:
+        def run():
+            autoparser.render(content, ("txt", "xml"))
+
+    run()
+    repeats = max(5, 2000 // positions)
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(repeats):
+        _timed(run, latencies)()
+    return _result(latencies, repeats, time.perf_counter() - start)
+
+
+def _prepare_services(work_dir: str) -> str:
+    """Create a working directory with config files pointing to stand-ins
+
+    returns:
+        (str): Root directory of the FTP stand-in
+    """
+    shutil.copytree(os.path.join(_REPO_ROOT, "data", "templates"), os.path.join(work_dir, "data", "templates"))
+    shutil.copy(os.path.join(_REPO_ROOT, "data", "config.json"), os.path.join(work_dir, "data", "config.json"))
+    os.makedirs(os.path.join(work_dir, "data", "cache"))
+
+    ftp_root = os.path.join(work_dir, "ftp")
+    for directory in ("out", "in"):
+        os.makedirs(os.path.join(ftp_root, directory))
+    _, ftp_port = standins.start_ftp(ftp_root)
+    _, smtp_port = standins.start_smtp()
+
+    ftp_config = {"hostname": "127.0.0.1", "port": ftp_port, "username": "bench", "password": "bench",
+                  "files_out": "out", "files_in": "in"}
+    servers = {
+        "server_customer.json": ftp_config,
+        "server_payment.json": ftp_config,
+        "server_email.json": {"hostname": "127.0.0.1", "port": smtp_port, "use_ssl": False,
+                              "username": "bench", "password": "bench"}
+    }
+    for file_name, server_config in servers.items():
+        with open(os.path.join(work_dir, "data", file_name), "w") as file:
+            json.dump(server_config, file)
+
+    os.chdir(work_dir)
+    return ftp_root
+
+
+def _set_mode(mode: str) -> None:
+    import config
+
+    with open(config._GENERAL_CONFIG) as file:
+        general_config = json.load(file)
+    general_config["pipeline"]["enabled"] = mode == "pipeline"
+    general_config["async_network"]["enabled"] = mode == "async"
+    with open(config._GENERAL_CONFIG, "w") as file:
+        json.dump(general_config, file)
+    config.reload()
+
+
+def _put_invoices(ftp_root: str, count: int) -> None:
+    for invoice_nr in range(1, count + 1):
+        with open(os.path.join(ftp_root, "out", f"rechnung{invoice_nr}.data"), "wb") as file:
+            file.write(datagen.generate_invoice(invoice_nr, 10, escape_ratio=0.05))
+
+
+def _run_main(main: Callable) -> None:
+    try:
+        main()
+    except SystemExit:
+        pass
+
+
+def _bench_service_parse(mode: str, count: int) -> Dict[str, float]:
+    with tempfile.TemporaryDirectory() as work_dir:
+        ftp_root = _prepare_services(work_dir)
+        _set_mode(mode)
+        import service_parse
+
+        latencies = []
+        if mode == "pipeline":
+            service_parse.parse_invoice = _timed(service_parse.parse_invoice, latencies)
+        elif mode == "async":
+            service_parse.process_invoice_async = _timed(service_parse.process_invoice_async, latencies)
+        else:
+            service_parse.process_invoice = _timed(service_parse.process_invoice, latencies)
+
+        _put_invoices(ftp_root, count)
+        start = time.perf_counter()
+        _run_main(service_parse.main)
+        seconds = time.perf_counter() - start
+        os.chdir(_REPO_ROOT)
+        # Processed files are deleted from the out directory
+        return _result(latencies, count, seconds, failed=len(os.listdir(os.path.join(ftp_root, "out"))))
+
+
+def _bench_service_zip(mode: str, count: int) -> Dict[str, float]:
+    with tempfile.TemporaryDirectory() as work_dir:
+        ftp_root = _prepare_services(work_dir)
+        _set_mode("sequential")
+        import service_parse
+        import service_zip
+
+        _put_invoices(ftp_root, count)
+        _run_main(service_parse.main)
+        for invoice_nr in range(1, count + 1):
+            receipt_time = time.strftime("%H%M%S", time.gmtime(invoice_nr))
+            receipt_name = f"quittungsfile20210131_{receipt_time}.txt"
+            with open(os.path.join(ftp_root, "out", receipt_name), "wb") as file:
+                file.write(datagen.generate_receipt(invoice_nr))
+
+        _set_mode(mode)
+        latencies = []
+        if mode == "async":
+            service_zip.process_receipt_async = _timed(service_zip.process_receipt_async, latencies)
+        else:
+            service_zip.process_receipt = _timed(service_zip.process_receipt, latencies)
+
+        start = time.perf_counter()
+        _run_main(service_zip.main)
+        seconds = time.perf_counter() - start
+        os.chdir(_REPO_ROOT)
+        # Processed files are deleted from the out directory
+        return _result(latencies, count, seconds, failed=len(os.listdir(os.path.join(ftp_root, "out"))))
+
+
+def _bench_startup(name: str, repeats: int) -> Dict[str, float]:
+    """Time the start of fresh interpreters
+
+    startup.import_<module> imports a module with -X importtime,
+    startup.idle_<service> runs service_cron.py with an empty files out
+    directory. p50_ms and p99_ms are wall times of the whole process.
+    """
+    with tempfile.TemporaryDirectory() as work_dir:
+        _prepare_services(work_dir)
+        # Cron runs use the cached bytecode, so it is written even if disabled for this process
+        env = {key: value for key, value in os.environ.items() if key != "PYTHONDONTWRITEBYTECODE"}
+        env["PYTHONPATH"] = os.path.join(_REPO_ROOT, "src")
+
+        kind, _, target = name.split(".")[1].partition("_")
+        if kind == "import":
+            command = [sys.executable, "-X", "importtime", "-c", f"import {target}"]
+        else:
+            command = [sys.executable, os.path.join(_REPO_ROOT, "src", "service_cron.py"), target]
+
+        latencies = []
+        import_times = []
+        start = time.perf_counter()
+        # The first run writes the bytecode and is not counted
+        for run in range(repeats + 1):
+            started = time.perf_counter()
+            process = subprocess.run(command, env=env, capture_output=True, text=True, check=True)
+            if run:
+                latencies.append(time.perf_counter() - started)
+                if kind == "import":
+                    import_times.append(_parse_importtime(process.stderr))
+        seconds = time.perf_counter() - start
+        os.chdir(_REPO_ROOT)
+
+    result = _result(latencies, repeats, seconds)
+    del result["invoices_per_sec"]
+    result["peak_rss_kb"] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    if import_times:
+        result["import_ms"] = round(statistics.median(total for total, _ in import_times) / 1000, 3)
+        # Modules with the most own import time in the last run
+        result["slowest_imports_ms"] = {module: round(own / 1000, 3) for module, own in sorted(
+            import_times[-1][1].items(), key=lambda item: item[1], reverse=True)[:10]}
+    return result
+
+
+def _parse_importtime(output: str) -> (int, Dict[str, int]):
+    """Get the total and the own import time of every module in microseconds from -X importtime output"""
+    total = 0
+    own_times = {}
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "|" not in line or "self [us]" in line:
+            continue
+        own, cumulative, module = line[len("import time:"):].split("|")
+        own_times[module.strip()] = int(own)
+        if not module.startswith("  "):
+            # Top level imports, the modules of the interpreter start and the imported module
+            total += int(cumulative)
+    return total, own_times
+
+
+def run_case(case: str) -> Dict[str, float]:
+    """Run one benchmark case in this process
+
+    args:
+        case (str): Case name in the format name:size
+
+    returns:
+        (Dict[str, float]): Measured metrics
+    """
+    logging.disable(logging.CRITICAL)
+    name, size = case.split(":")
+    if name.startswith("autoparser."):
+        return _bench_autoparser(name, int(size))
+    if name.startswith("service_parse."):
+        return _bench_service_parse(name.split(".")[1], int(size))
+    if name.startswith("service_zip."):
+        return _bench_service_zip(name.split(".")[1], int(size))
+    if name.startswith("startup."):
+        return _bench_startup(name, int(size))
+    raise ValueError(f"Unknown benchmark case '{case}'")
+
+
+def compare(old: dict, new: dict) -> None:
+    """Print the change of every metric between two result files"""
+    for case, metrics in new["results"].items():
+        old_metrics = old["results"].get(case)
+        if not old_metrics:
+            continue
+        changes = []
+        for metric, higher_is_better in _METRICS.items():
+            if not old_metrics.get(metric) or metrics.get(metric) is None:
+                continue
+            change = (metrics[metric] - old_metrics[metric]) / old_metrics[metric] * 100
+            regression = change < -10 if higher_is_better else change > 10
+            changes.append(f"{metric} {change:+.1f}%{' REGRESSION' if regression else ''}")
+        print(f"{case:45} {', '.join(changes)}")
+
+
+def _git_commit() -> str or None:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=_REPO_ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", help="File to write the JSON results to (default: stdout)")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare with")
+    parser.add_argument("--quick", action="store_true", help="Run smaller cases")
+    parser.add_argument("--filter", default="", help="Only run cases containing this string")
+    parser.add_argument("--case", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        print(json.dumps(run_case(args.case)))
+        return
+
+    results = {}
+    for case in _cases(args.quick):
+        if args.filter not in case:
+            continue
+        process = subprocess.run([sys.executable, os.path.abspath(__file__), "--case", case],
+                                 capture_output=True, text=True)
+        if process.returncode != 0:
+            print(f"{case} failed:\n{process.stderr}", file=sys.stderr)
+            continue
+        results[case] = json.loads(process.stdout.splitlines()[-1])
+        print(f"{case:45} {results[case]}", file=sys.stderr)
+
+    output = {
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "results": results
+    }
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(output, file, indent=2)
+    else:
+        print(json.dumps(output, indent=2))
+
+    if args.compare:
+        with open(args.compare) as file:
+            compare(json.load(file), output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""Synthetic invoice data files for benchmarks
+
+The header rows are taken from data/templates/invoice.data, the positions
+are generated.
+"""
+import random
+
+_SAMPLE_DATA_FILE = "./data/templates/invoice.data"
+
+# Characters that have to be escaped in the XML output
+_XML_SPECIAL = "&<>"
+
+
+def generate_invoice(invoice_nr: int, positions: int, field_length: int = 24,
+                     escape_ratio: float = 0.0, seed: int = 0) -> bytes:
+    """Generate the content of an invoice data file
+
+    args:
+        invoice_nr (int): Invoice number, written to the header
+        positions (int): Number of RechnPos rows
+        field_length (int): Length of the position description
+        escape_ratio (float): Share of description characters that need XML escaping
+        seed (int): Seed of the random generator
+
+    returns:
+        (bytes): Content of the data file
+    """
+    rng = random.Random(seed + invoice_nr)
+    with open(_SAMPLE_DATA_FILE, encoding="utf-8") as sample:
+        header = sample.read().splitlines()[:3]
+    _, *rest = header[0].split(";")
+    header[0] = ";".join([f"Rechnung_{invoice_nr}"] + rest)
+
+    rows = list(header)
+    for index in range(1, positions + 1):
+        description = "".join(
+            rng.choice(_XML_SPECIAL) if rng.random() < escape_ratio else rng.choice("abcdefghijklmnopqrstuvwxyz ")
+            for _ in range(field_length))
+        quantity = rng.randint(1, 20)
+        unit_cents = rng.randint(100, 100000)
+        line_cents = quantity * unit_cents
+        rows.append(f"RechnPos;{index};{description};{quantity};{unit_cents // 100}.{unit_cents % 100:02d};"
+                    f"{line_cents // 100}.{line_cents % 100:02d};MWST_0.00%")
+
+    return "\n".join(rows).encode("utf-8")
+
+
+def generate_receipt(invoice_nr: int) -> bytes:
+    """Generate the content of a receipt for an invoice
+
+    args:
+        invoice_nr (int): Invoice number the receipt refers to
+
+    returns:
+        (bytes): Content of the receipt
+    """
+    return f"Zahlungseingang Rechnung {invoice_nr}\nBetrag erhalten\n".encode("utf-8")
@@ -0,0 +1,226 @@
+"""In-process FTP and SMTP servers for benchmarks
+
+Both servers only implement the commands the services use and accept
+any credentials. The FTP server serves a local directory.
+"""
+import os
+import socket
+import socketserver
+import threading
+import time
+from typing import List, Tuple
+
+
+class _LineHandler(socketserver.StreamRequestHandler):
+    # Send replies immediately like real servers, not after the delayed ACK
+    disable_nagle_algorithm = True
+
+    def reply(self, line: str):
+        self.wfile.write(f"{line}\r\n".encode())
+
+    def read_command(self) -> Tuple[str, str] or None:
+        line = self.rfile.readline()
+        if not line:
+            return None
+        command, _, argument = line.decode().rstrip("\r\n").partition(" ")
+        return command.upper(), argument
+
+
+class _FtpHandler(_LineHandler):
+    def handle(self):
+        root = os.path.realpath(self.server.root)
+        cwd = root
+        rest = 0
+        rename_from = None
+        passive = None
+        self.reply("220 Stand-in FTP server")
+        while True:
+            request = self.read_command()
+            if not request:
+                break
+            command, argument = request
+            if argument.startswith("/"):
+                path = os.path.realpath(os.path.join(root, argument.lstrip("/")))
+            else:
+                path = os.path.realpath(os.path.join(cwd, argument)) if argument else cwd
+            if not path.startswith(root):
+                self.reply("550 Outside of root")
+                continue
+
+            if command == "USER":
+                self.reply("331 Password required")
+            elif command == "PASS":
+                self.reply("230 Logged in")
+            elif command in ("TYPE", "MODE", "STRU"):
+                self.reply("200 OK")
+            elif command == "NOOP":
+                self.reply("200 NOOP ok")
+            elif command == "FEAT":
+                self.wfile.write(b"211-Features:\r\n MLSD\r\n REST STREAM\r\n SIZE\r\n211 End\r\n")
+            elif command == "PWD":
+                relative = os.path.relpath(cwd, root)
+                self.reply(f'257 "/{"" if relative == "." else relative}"')
+            elif command == "CWD":
+                if os.path.isdir(path):
+                    cwd = path
+                    self.reply("250 OK")
+                else:
+                    self.reply("550 No such directory")
+            elif command == "SIZE":
+                if os.path.isfile(path):
+                    self.reply(f"213 {os.path.getsize(path)}")
+                else:
+                    self.reply("550 No such file")
+            elif command == "REST":
+                rest = int(argument)
+                self.reply(f"350 Restarting at {rest}")
+            elif command == "PASV":
+                passive = socket.socket()
+                passive.bind(("127.0.0.1", 0))
+                passive.listen(1)
+                port = passive.getsockname()[1]
+                self.reply(f"227 Entering Passive Mode (127,0,0,1,{port >> 8},{port & 255})")
+            elif command in ("NLST", "MLSD", "RETR", "STOR", "APPE"):
+                if not passive:
+                    self.reply("425 Use PASV first")
+                    continue
+                if command in ("NLST", "MLSD") and not os.path.isdir(path):
+                    self.reply("550 No such directory")
+                    continue
+                if command == "RETR" and not os.path.isfile(path):
+                    self.reply("550 No such file")
+                    continue
+                self.reply("150 Opening data connection")
+                data, _ = passive.accept()
+                passive.close()
+                passive = None
+                try:
+                    self.transfer(command, path, data, rest)
+                except (BrokenPipeError, ConnectionResetError) as _:
+                    # The client aborted the transfer
+                    rest = 0
+                    self.reply("426 Transfer aborted")
+                    continue
+                rest = 0
+                self.reply("226 Transfer complete")
+            elif command == "DELE":
+                if os.path.isfile(path):
+                    os.remove(path)
+                    self.reply("250 Deleted")
+                else:
+                    self.reply("550 No such file")
+            elif command == "RNFR":
+                if os.path.exists(path):
+                    rename_from = path
+                    self.reply("350 Ready for RNTO")
+                else:
+                    self.reply("550 No such file")
+            elif command == "RNTO":
+                if rename_from:
+                    os.replace(rename_from, path)
+                    rename_from = None
+                    self.reply("250 Renamed")
+                else:
+                    self.reply("503 Use RNFR first")
+            elif command == "QUIT":
+                self.reply("221 Bye")
+                break
+            else:
+                self.reply(f"502 {command} not implemented")
+
+    @staticmethod
+    def transfer(command: str, path: str, data: socket.socket, rest: int):
+        with data:
+            if command == "NLST":
+                data.sendall("".join(f"{name}\r\n" for name in sorted(os.listdir(path))).encode())
+            elif command == "MLSD":
+                data.sendall(_mlsd(path).encode())
+            elif command == "RETR":
+                with open(path, "rb") as file:
+                    data.sendfile(file, offset=rest)
+            else:
+                mode = "ab" if command == "APPE" else ("r+b" if rest and os.path.exists(path) else "wb")
+                with open(path, mode) as file:
+                    if mode == "r+b":
+                        file.seek(rest)
+                        file.truncate()
+                    while True:
+                        chunk = data.recv(65536)
+                        if not chunk:
+                            break
+                        file.write(chunk)
+
+
+def _mlsd(path: str) -> str:
+    lines = []
+    for name in sorted(os.listdir(path)):
+        stat = os.stat(os.path.join(path, name))
+        kind = "dir" if os.path.isdir(os.path.join(path, name)) else "file"
+        modify = time.strftime("%Y%m%d%H%M%S", time.gmtime(stat.st_mtime))
+        lines.append(f"type={kind};size={stat.st_size};modify={modify}; {name}\r\n")
+    return "".join(lines)
+
+
+class _SmtpHandler(_LineHandler):
+    def handle(self):
+        self.reply("220 Stand-in SMTP server")
+        while True:
+            request = self.read_command()
+            if not request:
+                break
+            command, argument = request
+            if command in ("EHLO", "HELO"):
+                self.wfile.write(b"250-stand-in\r\n250-AUTH PLAIN\r\n250 8BITMIME\r\n")
+            elif command == "AUTH":
+                self.reply("235 Authenticated")
+            elif command in ("MAIL", "RCPT", "RSET", "NOOP"):
+                self.reply("250 OK")
+            elif command == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                size = 0
+                while True:
+                    line = self.rfile.readline()
+                    if not line or line == b".\r\n":
+                        break
+                    size += len(line)
+                self.server.messages.append(size)
+                self.reply("250 Queued")
+            elif command == "QUIT":
+                self.reply("221 Bye")
+                break
+            else:
+                self.reply(f"502 {command} not implemented")
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def start_ftp(root: str) -> Tuple[_Server, int]:
+    """Serve a directory over FTP in a background thread
+
+    args:
+        root (str): Directory to serve
+
+    returns:
+        (_Server, int): Server and its port
+    """
+    server = _Server(("127.0.0.1", 0), _FtpHandler)
+    server.root = root
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, server.server_address[1]
+
+
+def start_smtp() -> Tuple[_Server, int]:
+    """Accept mails over plain SMTP in a background thread
+
+    The sizes of all received mails are collected in server.messages.
+
+    returns:
+        (_Server, int): Server and its port
+    """
+    server = _Server(("127.0.0.1", 0), _SmtpHandler)
+    server.messages: List[int] = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, server.server_address[1]
@@ -0,0 +1,158 @@
+import asyncio
+import ftplib
+import functools
+import logging
+import weakref
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional
+
+import autoparser
+import config
+import ledger
+import network
+import profiling
+
+# Semaphores limiting concurrent operations per host, by event loop
+_HOST_LIMITS: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[str, asyncio.Semaphore]]" = \
+    weakref.WeakKeyDictionary()
+
+
+async def download_invoices(server_config: config.ServerConfig,
+                            callback: Callable[[str, bytes, autoparser.Invoice], Awaitable[bool]]) -> None:
+    """Downloads and processes all invoices concurrently
+
+    Invoices are parsed while they are downloaded, see network.download_invoices.
+
+    args:
+        server_config (config.ServerConfig): Credentials for server
+        callback (Callable[[str, bytes, autoparser.Invoice], Awaitable[bool]]): Coroutine to process one file
+    """
+    async def process(remote_file: network.RemoteFile):
+        invoice_name = remote_file.name
+        try:
+            invoice_content, invoice = await _run(server_config, network.retrieve_invoice, server_config,
+                                                  server_config.files_out, remote_file)
+        except (IndexError, ValueError) as e:
+            logging.error(f"Failed to process invoice {invoice_name}: {e}")
+            logging.info(f"Skipped invoice {invoice_name}")
+            return
+        logging.info(f"Downloaded invoice {invoice_name}")
+        logging.info(f"Processing invoice {invoice_name}")
+        with profiling.span("process_invoice", invoice=invoice_name):
+            processed = await callback(invoice_name, invoice_content, invoice)
+        if processed:
+            await _run(server_config, network.delete_invoice, server_config, invoice_name)
+
+    await _process_all(server_config, config.get_invoice_pattern(), process)
+
+
+async def download_receipts(server_config: config.ServerConfig, open_invoice_nrs: Iterable[str],
+                            callback: Callable[[str, str, str], Awaitable[bool]]) -> None:
+    """Downloads and processes receipts of pending invoices concurrently
+
+    args:
+        server_config (config.ServerConfig): Credentials for server
+        open_invoice_nrs (Iterable[str]): Cached and pending invoice numbers
+        callback (Callable[[str, str, str], Awaitable[bool]]): Coroutine to process one receipt
+    """
+    open_invoices = frozenset(open_invoice_nrs)
+
+    async def process(remote_file: network.RemoteFile):
+        receipt_name = remote_file.name
+        if network.is_unchanged_unmatched(server_config, remote_file, open_invoices):
+            logging.info(f"Skipped unchanged receipt {receipt_name} without an open invoice")
+            return
+        receipt_content = (await retrieve_file(server_config, server_config.files_out, receipt_name,
+                                               remote_file.size, remote_file.modify)).decode('utf-8')
+        invoice_nr = autoparser.get_receipt_invoice_number(receipt_content, open_invoices)
+        if not invoice_nr:
+            network.record_unmatched(server_config, remote_file, receipt_content)
+            logging.info(f"Ignored receipt {receipt_name}: no match among {len(open_invoices)} open invoices")
+            return
+        logging.info(f"Downloaded receipt {receipt_name}")
+        logging.info(f"Processing receipt {receipt_name}")
+        with profiling.span("process_receipt", receipt=receipt_name):
+            processed = await callback(receipt_name, receipt_content, invoice_nr)
+        if processed:
+            await delete_file(server_config, server_config.files_out, receipt_name)
+            logging.info(f"Deleted receipt {receipt_name}")
+
+    await _process_all(server_config, config.get_receipt_pattern(), process, prune=True)
+
+
+async def list_remote_files(server_config: config.ServerConfig, regex_pattern: str) -> List[network.RemoteFile]:
+    """Async version of network.list_remote_files"""
+    return await _run(server_config, network.list_remote_files, server_config, regex_pattern)
+
+
+async def retrieve_file(server_config: config.ServerConfig, path: str, filename: str,
+                        size: Optional[int] = None, modify: Optional[str] = None) -> bytes:
+    """Async version of network.retrieve_file"""
+    return await _run(server_config, network.retrieve_file, server_config, path, filename, size, modify)
+
+
+async def store_file(server_config: config.ServerConfig, path: str, filename: str, content: bytes) -> None:
+    """Async version of network.store_file"""
+    await _run(server_config, network.store_file, server_config, path, filename, content)
+    logging.info(f"Uploaded file {filename} to {server_config.hostname}")
+
+
+async def delete_file(server_config: config.ServerConfig, path: str, filename: str) -> None:
+    """Async version of network.delete_file"""
+    await _run(server_config, network.delete_file, server_config, path, filename)
+
+
+async def send_mail(*args, **kwargs) -> None:
+    """Async version of network.send_mail"""
+    await _run(config.get_server_config(config.Server.EMAIL), network.send_mail, *args, **kwargs)
+
+
+async def _process_all(server_config: config.ServerConfig, regex_pattern: str,
+                       process: Callable[[network.RemoteFile], Awaitable[None]], prune: bool = False) -> None:
+    """Run a coroutine for every matching file with a bounded number in flight
+
+    Errors of one file are logged and leave the file on the server.
+
+    args:
+        server_config (config.ServerConfig): Credentials for server
+        regex_pattern (str): Regex pattern that files have to match
+        process (Callable[[network.RemoteFile], Awaitable[None]]): Coroutine to process one file
+        prune (bool): Forget recorded files of the directory that are no longer listed
+    """
+    try:
+        remote_files = await list_remote_files(server_config, regex_pattern)
+    except ftplib.error_perm as e:
+        logging.fatal(f"Server error: {e}")
+        exit(0)
+    if prune:
+        ledger.prune_remote_files(server_config.hostname, server_config.files_out,
+                                  [remote_file.name for remote_file in remote_files])
+
+    in_flight = asyncio.Semaphore(config.get_async_network_config()["files_in_flight"])
+
+    async def process_bounded(remote_file: network.RemoteFile):
+        async with in_flight:
+            try:
+                await process(remote_file)
+            except (Exception, SystemExit) as e:
+                logging.error(f"Failed to process file {remote_file.name}: {e}")
+
+    await asyncio.gather(*(process_bounded(remote_file) for remote_file in remote_files))
+
+
+async def _run(server_config: config.ServerConfig, function: Callable, *args, **kwargs):
+    """Run a blocking network function in the executor
+
+    At most async_network/host_concurrency functions run at once per host.
+
+    args:
+        server_config (config.ServerConfig): Server the function talks to
+        function (Callable): Blocking function to run
+    """
+    loop = asyncio.get_running_loop()
+    limits = _HOST_LIMITS.setdefault(loop, {})
+    if server_config.hostname not in limits:
+        limits[server_config.hostname] = asyncio.Semaphore(
+            config.get_async_network_config()["host_concurrency"])
+
+    async with limits[server_config.hostname]:
+        return await loop.run_in_executor(None, functools.partial(function, *args, **kwargs))
@@ -1,63 +1,305 @@
+from array import array
+from codecs import getincrementaldecoder
 from datetime import datetime, timedelta
+from functools import lru_cache
 
 import config
+import ledger
+import metrics
+import itertools
+import operator
+import os
 import re
 import string
 import logging
-from typing import Callable, Dict, List
-from xml.sax import saxutils
+from typing import Callable, Container, Dict, FrozenSet, Iterable, Iterator, List, NamedTuple, Optional, Tuple
 
+_AUTOPARSE_PLACEHOLDER = re.compile(r"autoparse_(\d)(\d)")
 
-def parse_xml(content: bytes):
-    """Parse data file to text file
+_PARSE_SECONDS = metrics.histogram("autoparser_parse_seconds", "Time to parse and validate a data file")
+_RENDER_SECONDS = metrics.histogram("autoparser_render_seconds", "Time to render a parsed invoice", ("format",))
+_POSITIONS = metrics.histogram("invoice_positions", "Number of positions per invoice",
+                               buckets=(1, 5, 10, 50, 100, 500, 1000, 10000, 100000, 1000000))
+
+# Exact decimal number with at most 15 digits before the point, so fixed-point values fit into 64 bits
+_NUMBER = re.compile(r"(-?)(\d{1,15})(?:\.(\d+))?")
+
+# Decimals of the fixed-point columns: quantities in thousandths, prices in cents,
+# VAT rates in hundredths of a percent
+_QUANTITY_DECIMALS = 3
+_PRICE_DECIMALS = 2
+_RATE_DECIMALS = 2
+
+# Positions validated and summed up at once while streaming
+_BATCH_SIZE = 4096
+
+# Characters str.splitlines() splits at
+_LINE_BREAKS = frozenset("\n\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029")
+
+# Number of columns of the three header rows and of a position row
+_HEADER_COLUMNS = (6, 8, 5)
+_POSITION_COLUMNS = 7
+
+# Template values that are only known after all positions were read
+_TOTAL_NAMES = frozenset({"position_count", "price_total", "vat_total", "price_total_gross", "taxes"})
+
+# Alphanumeric words of a receipt, "Rechnung_21003" yields "Rechnung" and "21003"
+_RECEIPT_TOKEN = re.compile(r"[^\W_]+")
+
+# Invoice number field of a receipt: "Rechnung_21003", "Rechnung Nr. 21003", "Rechnungsnummer: 21003"
+_RECEIPT_INVOICE_FIELD = re.compile(r"\bRechnung(?:snummer|s-?nr\.?|\s+nr\.?)?[\s_:#.-]*([^\W_]+)", re.IGNORECASE)
+
+
+class _CompiledTemplate(NamedTuple):
+    """Template split into literal chunks and placeholder slots
+
+    parts holds the literal chunks with an empty string at every slot index.
+    auto_slots maps a slot index to its (row, col) in the data matrix,
+    static_slots maps a slot index to its key in the ignore dict.
+    """
+    parts: Tuple[str, ...]
+    auto_slots: Tuple[Tuple[int, int, int], ...]
+    static_slots: Tuple[Tuple[int, str], ...]
+
+
+# Compiled templates by path: (mtime_ns, compiled template)
+_TEMPLATE_CACHE: Dict[str, Tuple[int, _CompiledTemplate]] = {}
+
+
+class Columns(NamedTuple):
+    """Typed columns of RechnPos rows as exact fixed-point integers
+
+    quantities are in thousandths, unit_prices and line_totals in cents
+    and vat_rates in hundredths of a percent ("MWST_7.70%" is 770).
+    """
+    quantities: array
+    unit_prices: array
+    line_totals: array
+    vat_rates: array
+
+
+class Totals(NamedTuple):
+    """Totals of an invoice in cents
+
+    taxable_by_rate holds the sum of the line totals by VAT rate, the VAT
+    is rounded once per rate.
+    """
+    position_count: int
+    price_total: int
+    taxable_by_rate: Dict[int, int]
+
+    @property
+    def vat_by_rate(self) -> Dict[int, int]:
+        return {rate: _get_vat(taxable, rate) for rate, taxable in self.taxable_by_rate.items()}
+
+    @property
+    def vat_total(self) -> int:
+        return sum(self.vat_by_rate.values())
+
+
+class Invoice(NamedTuple):
+    """Parsed and validated invoice data file
+
+    header holds the first three rows of the data file, already prepared
+    for auto parsing. positions holds all RechnPos rows, columns the
+    amounts of all positions and digest the content hash of the data
+    file, see ledger.get_digest().
+    """
+    header: Tuple[Tuple[str, ...], ...]
+    positions: Tuple[Tuple[str, ...], ...]
+    columns: Columns
+    due_date: str
+    deadline: str
+    totals: Totals
+    digest: str
+
+
+def parse(content: bytes) -> Invoice:
+    """Parse and validate a data file once
 
     args:
         content (bytes): Content of the data file
 
-    return:
-        Parsed XML file
+    returns:
+        (Invoice): Invoice model that can be rendered to any format
+
+    raises:
+        IndexError: Data file has not the right amount of rows or columns
+        ValueError: Data file is not UTF-8, a position has an invalid amount
+                    or its line total is not quantity × unit price
     """
-    data_matrix = _generate_matrix(content)
+    parser = DataFileParser()
+    parser.feed(content)
+    return parser.close()
 
-    _check_matrix(data_matrix)
 
-    # Calculate fields that are not in the data file
-    due_date = f"{data_matrix[0][3]} {data_matrix[0][4]}"
-    deadline = _calculate_deadline(data_matrix)
-    position_count = len(data_matrix[3:])
-    price_total = _calculate_price_total(data_matrix)
+class DataFileParser:
+    """Incremental parser for data files that arrive chunk by chunk
+
+    The chunks are decoded and split into rows as they arrive, e.g. from
+    the callback of ftplib.FTP.retrbinary(). Each header row is validated
+    as soon as it is complete and positions are validated in batches, so a
+    malformed file is rejected with its first bad row instead of after the
+    whole download. The content hash is computed from the same chunks.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self) -> None:
+        """Forget all fed chunks to parse a file from its start again"""
+        self._decoder = getincrementaldecoder("utf-8")()
+        self._digest = ledger.new_digest()
+        self._pending = ""
+        self._header: List[List[str]] = []
+        self._positions: List[List[str]] = []
+        self._columns = Columns(array("q"), array("q"), array("q"), array("q"))
+        self._price_total = 0
+        self._taxable_by_rate: Dict[int, int] = {}
+
+    def feed(self, chunk: bytes) -> None:
+        """Parse the complete rows of a chunk and validate them
+
+        args:
+            chunk (bytes): Next bytes of the data file
+
+        raises:
+            IndexError: A row has not the right amount of columns
+            ValueError: Invalid UTF-8 or an invalid position, see parse()
+        """
+        self._digest.update(chunk)
+        text = self._pending + self._decoder.decode(chunk)
+        lines = text.splitlines(keepends=True)
+        # Keep an incomplete last line, and a trailing \r that may be followed by \n in the next chunk
+        self._pending = lines.pop() if lines and (lines[-1][-1] not in _LINE_BREAKS or text.endswith("\r")) else ""
+        if lines:
+            self._add_rows("".join(lines).splitlines())
+
+    def close(self) -> Invoice:
+        """Parse the last row and build the invoice
+
+        returns:
+            (Invoice): Invoice model that can be rendered to any format
+
+        raises:
+            IndexError: Data file has not the right amount of rows or columns
+            ValueError: Invalid UTF-8 or an invalid position, see parse()
+        """
+        text = self._pending + self._decoder.decode(b"", final=True)
+        self._pending = ""
+        self._add_rows(text.splitlines())
+        if len(self._header) < len(_HEADER_COLUMNS):
+            raise IndexError("Not enough rows to process file")
+        self._check_positions(len(self._positions))
+
+        # Calculate fields that are not in the data file
+        header = self._header
+        due_date = f"{header[0][3]} {header[0][4]}"
+        deadline = _calculate_deadline(header)
+        _invoice_prep(header)
+        _POSITIONS.observe(len(self._positions))
+
+        return Invoice(
+            header=tuple(map(tuple, header)),
+            positions=tuple(map(tuple, self._positions)),
+            columns=self._columns,
+            due_date=due_date,
+            deadline=deadline,
+            totals=Totals(len(self._positions), self._price_total, self._taxable_by_rate),
+            digest=self._digest.hexdigest())
+
+    def _add_rows(self, lines: List[str]) -> None:
+        if not lines:
+            return
+        rows = [line.split(";") for line in lines]
+        header_rows = 0
+        while header_rows < len(rows) and len(self._header) < len(_HEADER_COLUMNS):
+            _check_header_row(len(self._header), rows[header_rows])
+            self._header.append(rows[header_rows])
+            header_rows += 1
+        if header_rows:
+            del rows[:header_rows]
+
+        if any(map(_POSITION_COLUMNS.__ne__, map(len, rows))):
+            wrong = next(itertools.compress(itertools.count(len(self._positions) + 1),
+                                            map(_POSITION_COLUMNS.__ne__, map(len, rows))))
+            raise IndexError(f"Position {wrong} has not the correct amount of columns")
+        self._positions.extend(rows)
+        if len(self._positions) - len(self._columns.line_totals) >= _BATCH_SIZE:
+            self._check_positions(len(self._positions) // _BATCH_SIZE * _BATCH_SIZE)
+
+    def _check_positions(self, end: int) -> None:
+        """Validate and sum up the positions that were not checked yet up to end"""
+        start = len(self._columns.line_totals)
+        if end <= start:
+            return
+        columns = _parse_columns(self._positions[start:end], start + 1)
+        self._price_total += _add_taxable(columns, self._taxable_by_rate)
+        if not start:
+            self._columns = columns
+            return
+        for column, batch in zip(self._columns, columns):
+            column.extend(batch)
+
+
+def render(content: bytes, formats=("txt", "xml")) -> Dict[str, Tuple[str, str]]:
+    """Parse a data file once and render it to one or more formats
+
+    args:
+        content (bytes): Content of the data file
+        formats (Iterable[str]): Formats to render, see _RENDERERS
+
+    returns:
+        (Dict[str, Tuple[str, str]]): File name and content by format
+
+    raises:
+        IndexError: Data file has not the right amount of rows or columns
+        ValueError: Unknown format or invalid position, see parse()
+    """
+    for file_format in formats:
+        if file_format not in _RENDERERS:
+            raise ValueError(f"Unknown invoice format '{file_format}'")
+
+    with _PARSE_SECONDS.time():
+        invoice = parse(content)
+
+    return render_invoice(invoice, formats)
 
-    ignore_dict = {
-        "positions": "$positions",
-        "deadline": deadline,
-        "position_count": position_count,
-        "price_total": price_total
-    }
 
-    # Parse the body of the file (Everything except positions)
-    body = _parse_file(
-        data_matrix, config.get_template("invoice_xml"),
-        _invoice_prep, ignore_dict)
+def render_invoice(invoice: Invoice, formats=("txt", "xml")) -> Dict[str, Tuple[str, str]]:
+    """Render a parsed invoice to one or more formats
 
-    # Parse positions
-    positions = ""
-    index_id = 1
-    for position in data_matrix[3:]:
-        if len(position) != 7:
-            raise IndexError(f"Position {index_id} has not the correct amount of columns")
+    args:
+        invoice (Invoice): Invoice from parse() or DataFileParser
+        formats (Iterable[str]): Formats to render, see _RENDERERS
 
-        position_parsed = _parse_file([position], config.get_template("invoice_positions_xml"), ignore_dict={
-            "position_id": str(index_id),
-            "due_date": due_date
-        })
-        positions += position_parsed
-        positions += "\n"
-        index_id += 1
+    returns:
+        (Dict[str, Tuple[str, str]]): File name and content by format
 
-    parsed_result = string.Template(body).substitute(
-        positions=positions)
+    raises:
+        ValueError: Unknown format
+    """
+    for file_format in formats:
+        if file_format not in _RENDERERS:
+            raise ValueError(f"Unknown invoice format '{file_format}'")
 
-    return _get_filename(data_matrix, "xml"), parsed_result
+    rendered = {}
+    for file_format in formats:
+        with _RENDER_SECONDS.time(format=file_format):
+            rendered[file_format] = _RENDERERS[file_format](invoice)
+    return rendered
+
+
+def parse_xml(content: bytes):
+    """Parse data file to XML file
+
+    args:
+        content (bytes): Content of the data file
+
+    return:
+        Parsed XML file
+    """
+    return render(content, ("xml",))["xml"]
 
 
 def parse_text(content: bytes) -> (str, str):
@@ -69,36 +311,170 @@ def parse_text(content: bytes) -> (str, str):
     return:
         Parsed TXT file
     """
-    data_matrix = _generate_matrix(content)
+    return render(content, ("txt",))["txt"]
 
-    _check_matrix(data_matrix)
 
-    ignore_dict = {
-        "positions": "$positions",
-        "deadline": _calculate_deadline(data_matrix)
-    }
+def render_stream(lines: Iterable[str], file_format: str) -> Tuple[str, Iterator[str]]:
+    """Render a data file to a format chunk by chunk
+
+    Only the header rows are read before returning. Positions are read,
+    validated and rendered one at a time while the chunks are consumed,
+    so memory use does not grow with the number of positions. The chunks
+    can be written to a file directly.
+
+    args:
+        lines (Iterable[str]): Lines of the data file, e.g. a file opened in text mode
+        file_format (str): Format to render, see _RENDERERS
+
+    returns:
+        (str, Iterator[str]): File name and chunks of the rendered file
+
+    raises:
+        IndexError: Data file has not the right amount of rows or columns,
+                    raised while iterating the chunks for positions
+        ValueError: Unknown format, or an invalid position (see parse())
+                    raised while iterating the chunks for positions
+    """
+    if file_format not in _RENDERERS:
+        raise ValueError(f"Unknown invoice format '{file_format}'")
+
+    lines = iter(lines)
+    header = [line.rstrip("\r\n").split(";") for line in itertools.islice(lines, 3)]
+    _check_matrix(header)
+
+    due_date = f"{header[0][3]} {header[0][4]}"
+    deadline = _calculate_deadline(header)
+    _invoice_prep(header)
+
+    def positions() -> Iterator[List[str]]:
+        index_id = 1
+        for line in lines:
+            position = line.rstrip("\r\n").split(";")
+            if len(position) != _POSITION_COLUMNS:
+                raise IndexError(f"Position {index_id} has not the correct amount of columns")
+            yield position
+            index_id += 1
+        _POSITIONS.observe(index_id - 1)
 
-    # Parse the body of the file (Everything except positions)
-    body = _parse_file(
-        data_matrix, config.get_template("invoice_txt"),
-        _invoice_prep, ignore_dict)
+    return _get_filename(header, file_format), _stream_invoice(header, positions(), due_date, deadline, file_format)
+
+
+def _stream_invoice(header, positions: Iterable, due_date: str, deadline: str, file_format: str,
+                    totals: Optional[Totals] = None) -> Iterator[str]:
+    """Render an invoice as chunks: body until the positions, every position, rest of the body
+
+    Without totals the positions are validated and summed up in batches
+    while they are rendered, so the totals can be used in the body after
+    $positions. They can only be used before $positions if they are passed.
+
+    args:
+        header (List[List]): Header rows, prepared for auto parsing
+        positions (Iterable[List]): Position rows
+        due_date (str): Due date of the invoice
+        deadline (str): Deadline of the invoice
+        file_format (str): Format to render
+        totals (Totals): Totals of the already validated positions
+
+    returns:
+        (Iterator[str]): Chunks of the rendered file
+    """
+    body_head, body_tail = _split_template(_load_template(config.get_template(f"invoice_{file_format}")), "positions")
+    position_template = _load_template(config.get_template(f"invoice_positions_{file_format}"))
+    body_names = {name for _, name in body_head.static_slots + body_tail.static_slots}
+    position_tax = "tax_amount" in {name for _, name in position_template.static_slots}
+
+    values = {"deadline": deadline}
+    if totals:
+        values.update(_get_total_values(totals))
+        if "taxes" in body_names:
+            values["taxes"] = _render_taxes(header, totals, file_format)
+    elif _TOTAL_NAMES & {name for _, name in body_head.static_slots}:
+        raise ValueError(f"Template invoice_{file_format} uses the totals before $positions")
+    yield _auto_parse(header, body_head, values)
+
+    position_count = 0
+    price_total = 0
+    taxable_by_rate = {}
+    positions = iter(positions)
+    for batch in iter(lambda: list(itertools.islice(positions, _BATCH_SIZE)), []):
+        columns = _parse_columns(batch, position_count + 1) if not totals or position_tax else None
+        if not totals:
+            price_total += _add_taxable(columns, taxable_by_rate)
+        for index, position in enumerate(batch):
+            position_count += 1
+            position_values = {
+                "position_id": str(position_count),
+                "due_date": due_date
+            }
+            if position_tax:
+                position_values["tax_amount"] = _format_fixed(
+                    _get_vat(columns.line_totals[index], columns.vat_rates[index]), _PRICE_DECIMALS)
+            # Pass 2 dimensional array for correct parsing (Y is always 0 in this case)
+            yield _auto_parse([position], position_template, ignore_dict=position_values)
+            yield "\n"
+
+    if not totals:
+        streamed = Totals(position_count, price_total, taxable_by_rate)
+        values.update(_get_total_values(streamed))
+        if "taxes" in body_names:
+            values["taxes"] = _render_taxes(header, streamed, file_format)
+    yield _auto_parse(header, body_tail, values)
+
+
+def _render_taxes(header, totals: Totals, file_format: str) -> str:
+    """Render the tax breakdown of an invoice, one block per VAT rate
+
+    args:
+        header (List[List]): Header rows, prepared for auto parsing
+        totals (Totals): Totals of the invoice
+        file_format (str): Format to render
+
+    returns:
+        (str): Rendered blocks, ordered by rate
+    """
+    template = _load_template(config.get_template(f"invoice_taxes_{file_format}"))
+    vat_by_rate = totals.vat_by_rate
+    return "\n".join(_auto_parse(header, template, {
+        "tax_rate": _format_fixed(rate, _RATE_DECIMALS),
+        "taxable_amount": _format_fixed(taxable, _PRICE_DECIMALS),
+        "tax_amount": _format_fixed(vat_by_rate[rate], _PRICE_DECIMALS)
+    }) for rate, taxable in sorted(totals.taxable_by_rate.items()))
+
+
+def _render_xml(invoice: Invoice) -> (str, str):
+    """Render an invoice to XML
+
+    args:
+        invoice (Invoice): Parsed invoice
+
+    returns:
+        (str, str): File name and content of the XML file
+    """
+    chunks = _stream_invoice(invoice.header, invoice.positions, invoice.due_date, invoice.deadline, "xml",
+                             totals=invoice.totals)
+
+    return _get_filename(invoice.header, "xml"), "".join(chunks)
+
+
+def _render_text(invoice: Invoice) -> (str, str):
+    """Render an invoice to text
+
+    args:
+        invoice (Invoice): Parsed invoice
 
-    # Parse positions
-    positions = ""
-    index_id = 1
-    for position in data_matrix[3:]:
-        if len(position) != 7:
-            raise IndexError(f"Position {index_id} has not the correct amount of columns")
+    returns:
+        (str, str): File name and content of the text file
+    """
+    chunks = _stream_invoice(invoice.header, invoice.positions, invoice.due_date, invoice.deadline, "txt",
+                             totals=invoice.totals)
 
-        # Pass 2 dimensional array for correct parsing (Y is always 0 in this case)
-        position_parsed = _parse_file([position], config.get_template("invoice_positions_txt"))
-        positions += position_parsed
-        positions += "\n"
-        index_id += 1
+    return _get_filename(invoice.header, "txt"), "".join(chunks)
 
-    parsed_result = string.Template(body).substitute(positions=positions)
 
-    return _get_filename(data_matrix, "txt"), parsed_result
+_RENDERERS: Dict[str, Callable[[Invoice], Tuple[str, str]]] = {
+    "txt": _render_text,
+    "xml": _render_xml
+}
 
 
 def _check_matrix(data_matrix: List[List]):
@@ -110,31 +486,203 @@ def _check_matrix(data_matrix: List[List]):
     raises:
         IndexError: Something is wrong
     """
-    if len(data_matrix) < 3:
+    if len(data_matrix) < len(_HEADER_COLUMNS):
         raise IndexError("Not enough rows to process file")
 
-    if len(data_matrix[0]) != 6:
-        raise IndexError("Row 1 has not the right amount of columns")
-    if len(data_matrix[1]) != 8:
-        raise IndexError("Row 1 has not the right amount of columns")
-    if len(data_matrix[2]) != 5:
-        raise IndexError("Row 1 has not the right amount of columns")
+    for row_index, row in enumerate(data_matrix[:len(_HEADER_COLUMNS)]):
+        _check_header_row(row_index, row)
+
+
+def _check_header_row(row_index: int, row: List[str]):
+    """Checks if a header row has the right amount of columns
+
+    raises:
+        IndexError: Row has not the right amount of columns
+    """
+    if len(row) != _HEADER_COLUMNS[row_index]:
+        raise IndexError(f"Row {row_index + 1} has not the right amount of columns")
 
 
-def _calculate_price_total(data_matrix: List[List]):
-    """Calculate price of all positions
+def _parse_columns(positions: List[List], first_id: int = 1) -> Columns:
+    """Parse the amounts of positions into typed columns and validate them
+
+    The line total of every position has to be quantity × unit price,
+    rounded half away from zero to the cent.
 
     args:
-        data_matrix (List[List]): Data matrix to work with
+        positions (List[List]): Position rows with 7 columns
+        first_id (int): Position number of the first row, used in errors
 
-    returns
-        (str): Total price of all positions
+    returns:
+        (Columns): Amounts of the positions
+
+    raises:
+        ValueError: An amount is invalid or a line total does not match
     """
-    price = 0
-    for position in data_matrix[3:]:
-        price += int(float(position[5]))
+    quantities, unit_prices, line_totals, vat_rates = (
+        tuple(map(operator.itemgetter(column), positions)) for column in range(3, 7))
+    columns = Columns(
+        quantities=_parse_column(quantities, _QUANTITY_DECIMALS, "quantity", first_id),
+        unit_prices=_parse_column(unit_prices, _PRICE_DECIMALS, "unit price", first_id),
+        line_totals=_parse_column(line_totals, _PRICE_DECIMALS, "line total", first_id),
+        vat_rates=_parse_column(vat_rates, _RATE_DECIMALS, "VAT rate", first_id, prefix="MWST_", suffix="%"))
+
+    # Compare exact products first, only positions that differ can still be correctly rounded
+    scale = 10 ** _QUANTITY_DECIMALS
+    products = map(operator.mul, columns.quantities, columns.unit_prices)
+    scaled_totals = map(operator.mul, columns.line_totals, itertools.repeat(scale))
+    for position_id in itertools.compress(itertools.count(first_id), map(operator.ne, products, scaled_totals)):
+        index = position_id - first_id
+        if _round_div(columns.quantities[index] * columns.unit_prices[index], scale) != columns.line_totals[index]:
+            raise ValueError(f"Position {position_id} has a line total that is not quantity × unit price")
+
+    return columns
+
+
+def _parse_column(values: Tuple[str, ...], decimals: int, name: str, first_id: int,
+                  prefix: str = "", suffix: str = "") -> array:
+    """Parse a column of decimal strings into a fixed-point integer array
+
+    Columns with few distinct values, like VAT rates, are parsed once per
+    distinct value. Columns where every value has exactly the given
+    decimals or none are validated with one regex and converted without a
+    Python call per value.
+
+    args:
+        values (Tuple[str, ...]): Values of the column
+        decimals (int): Decimals of the fixed-point integers
+        name (str): Name of the column, used in errors
+        first_id (int): Position number of the first value, used in errors
+        prefix (str): Text every value starts with, e.g. MWST_
+        suffix (str): Text every value ends with, e.g. %
+
+    returns:
+        (array): Signed 64 bit integers
+
+    raises:
+        ValueError: A value is invalid
+    """
+    distinct = set(values)
+    if len(distinct) * 8 <= len(values):
+        try:
+            parsed = {value: _parse_value(value, decimals, prefix, suffix) for value in distinct}
+            return array("q", map(parsed.__getitem__, values))
+        except ValueError:
+            # Search the invalid value below for the error message
+            pass
+    else:
+        joined = "\n".join(values)
+        canonical, whole = _get_column_patterns(prefix, suffix, decimals)
+        if canonical.fullmatch(joined):
+            numbers = joined.replace(prefix, "").replace(suffix, "").replace(".", "").split("\n")
+            return array("q", map(int, numbers))
+        if whole.fullmatch(joined):
+            numbers = joined.replace(prefix, "").replace(suffix, "").split("\n")
+            return array("q", map(operator.mul, map(int, numbers), itertools.repeat(10 ** decimals)))
+
+    column = array("q")
+    for position_id, value in enumerate(values, first_id):
+        try:
+            column.append(_parse_value(value, decimals, prefix, suffix))
+        except ValueError as e:
+            raise ValueError(f"Position {position_id} has an invalid {name}: {e}") from None
+    return column
+
+
+def _parse_value(value: str, decimals: int, prefix: str, suffix: str) -> int:
+    """Parse one value of a column, see _parse_column()"""
+    if not value.startswith(prefix) or not value.endswith(suffix):
+        raise ValueError(f"'{value}' does not look like {prefix}0.{'0' * decimals}{suffix}")
+    return _to_fixed(value[len(prefix):len(value) - len(suffix)], decimals)
+
+
+@lru_cache(maxsize=8)
+def _get_column_patterns(prefix: str, suffix: str, decimals: int) -> Tuple[re.Pattern, re.Pattern]:
+    """Get the patterns of whole columns with exactly the given decimals and with integers only"""
+    prefix, suffix = re.escape(prefix), re.escape(suffix)
+    canonical = rf"{prefix}-?\d{{1,15}}\.\d{{{decimals}}}{suffix}"
+    whole = rf"{prefix}-?\d{{1,15}}{suffix}"
+    return re.compile(rf"(?:{canonical}\n)*{canonical}"), re.compile(rf"(?:{whole}\n)*{whole}")
 
-    return price
+
+def _to_fixed(text: str, decimals: int) -> int:
+    """Convert a decimal string exactly to a fixed-point integer
+
+        e.g. _to_fixed("12.5", 2) == 1250
+
+    args:
+        text (str): Decimal number like "-1000.00"
+        decimals (int): Decimals of the fixed-point integer
+
+    returns:
+        (int): Value times 10 ** decimals
+
+    raises:
+        ValueError: Not a decimal number or more decimals than supported
+    """
+    match = _NUMBER.fullmatch(text.strip())
+    if not match:
+        raise ValueError(f"'{text}' is not a number")
+    sign, whole, fraction = match.groups()
+    fraction = fraction or ""
+    if len(fraction.rstrip("0")) > decimals:
+        raise ValueError(f"'{text}' has more than {decimals} decimals")
+
+    value = int(whole + fraction[:decimals].ljust(decimals, "0"))
+    return -value if sign else value
+
+
+def _add_taxable(columns: Columns, taxable_by_rate: Dict[int, int]) -> int:
+    """Add the line totals of positions to the taxable amounts by VAT rate
+
+    args:
+        columns (Columns): Amounts of the positions
+        taxable_by_rate (Dict[int, int]): Taxable cents by rate, updated in place
+
+    returns:
+        (int): Sum of the line totals in cents
+    """
+    price_total = sum(columns.line_totals)
+    rates = set(columns.vat_rates)
+    if len(rates) == 1:
+        rate = rates.pop()
+        taxable_by_rate[rate] = taxable_by_rate.get(rate, 0) + price_total
+        return price_total
+
+    for rate in rates:
+        taxable = sum(itertools.compress(columns.line_totals, map(rate.__eq__, columns.vat_rates)))
+        taxable_by_rate[rate] = taxable_by_rate.get(rate, 0) + taxable
+    return price_total
+
+
+def _get_total_values(totals: Totals) -> Dict[str, str]:
+    """Get the template values of the totals, amounts formatted like 1125.00"""
+    vat_total = totals.vat_total
+    return {
+        "position_count": str(totals.position_count),
+        "price_total": _format_fixed(totals.price_total, _PRICE_DECIMALS),
+        "vat_total": _format_fixed(vat_total, _PRICE_DECIMALS),
+        "price_total_gross": _format_fixed(totals.price_total + vat_total, _PRICE_DECIMALS)
+    }
+
+
+def _format_fixed(value: int, decimals: int) -> str:
+    """Format a fixed-point integer as decimal string, e.g. -1250 with 2 decimals as -12.50"""
+    whole, fraction = divmod(abs(value), 10 ** decimals)
+    return f"{'-' if value < 0 else ''}{whole}.{fraction:0{decimals}d}"
+
+
+def _get_vat(amount: int, rate: int) -> int:
+    """Get the VAT of an amount in cents at a rate in hundredths of a percent, rounded to the cent"""
+    return _round_div(amount * rate, 100 * 10 ** _RATE_DECIMALS)
+
+
+def _round_div(dividend: int, divisor: int) -> int:
+    """Divide integers and round half away from zero"""
+    quotient, remainder = divmod(abs(dividend), divisor)
+    if remainder * 2 >= divisor:
+        quotient += 1
+    return quotient if dividend >= 0 else -quotient
 
 
 def _calculate_deadline(data_matrix: List[List]):
@@ -172,26 +720,103 @@ def _generate_matrix(content):
         map(lambda line: line.split(";"), content.decode("utf-8").splitlines()))
 
 
-def _parse_file(
-        data_matrix: List[List], template_file: str,
-        prep_autoparse: Callable[[List[List]],None]=lambda a:a,
-        ignore_dict: Dict[str, str]={}):
-    """Parse a file with the auto-parser
+def _load_template(template_file: str) -> _CompiledTemplate:
+    """Get a compiled template from the template cache
+
+    The template file is only read and compiled again when its
+    modification time changed since it was cached.
 
     args:
-        data_matrix (List[List]): Data matrix from data file
-        template_file: Template file to use for parsing
-        prep_autoparse: Auto parse preparation function, if present
-        ignore_dict: Dictionary with static replacement parameters
+        template_file (str): Path of the template file
+
+    returns:
+        (_CompiledTemplate): Compiled template
+    """
+    mtime = os.stat(template_file).st_mtime_ns
+    cached = _TEMPLATE_CACHE.get(template_file)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    with open(template_file) as template:
+        compiled = _compile_template(template.read())
+    _TEMPLATE_CACHE[template_file] = (mtime, compiled)
+
+    return compiled
+
+
+def _compile_template(template: str) -> _CompiledTemplate:
+    """Tokenize a template string into literal chunks and placeholder slots
+
+    Uses the same placeholder syntax as string.Template ($name, ${name}
+    and $$ as escaped dollar sign).
+
+    args:
+        template (str): Template string with auto-parse placeholders
+
+    returns:
+        (_CompiledTemplate): Compiled template
+
+    raises:
+        ValueError: Template contains an invalid placeholder
+    """
+    parts = []
+    auto_slots = []
+    static_slots = []
+    literal = ""
+    last_end = 0
+    for match in string.Template.pattern.finditer(template):
+        literal += template[last_end:match.start()]
+        last_end = match.end()
+
+        if match.group("escaped") is not None:
+            literal += "$"
+            continue
+        if match.group("invalid") is not None:
+            raise ValueError(f"Invalid placeholder in template at position {match.start('invalid')}")
+
+        parts.append(literal)
+        literal = ""
+
+        name = match.group("named") or match.group("braced")
+        autoparse = _AUTOPARSE_PLACEHOLDER.fullmatch(name)
+        if autoparse:
+            auto_slots.append((len(parts), int(autoparse.group(1)), int(autoparse.group(2))))
+        else:
+            static_slots.append((len(parts), name))
+        parts.append("")
+
+    parts.append(literal + template[last_end:])
+
+    return _CompiledTemplate(tuple(parts), tuple(auto_slots), tuple(static_slots))
+
+
+@lru_cache(maxsize=32)
+def _split_template(template: _CompiledTemplate, name: str) -> Tuple[_CompiledTemplate, _CompiledTemplate]:
+    """Split a compiled template at a static placeholder
+
+    args:
+        template (_CompiledTemplate): Compiled template
+        name (str): Name of the placeholder to split at
 
     returns:
-        Auto-parse parsed file
+        (_CompiledTemplate, _CompiledTemplate): Template before and after the
+            placeholder, the whole template and an empty one if it is missing
     """
+    split_index = next((index for index, slot_name in template.static_slots if slot_name == name), None)
+    if split_index is None:
+        return template, _CompiledTemplate(("",), (), ())
 
-    prep_autoparse(data_matrix)
-    template = open(template_file).read()
+    head = _CompiledTemplate(
+        template.parts[:split_index],
+        tuple(slot for slot in template.auto_slots if slot[0] < split_index),
+        tuple(slot for slot in template.static_slots if slot[0] < split_index))
+    offset = split_index + 1
+    tail = _CompiledTemplate(
+        template.parts[offset:],
+        tuple((index - offset, row, col) for index, row, col in template.auto_slots if index > split_index),
+        tuple((index - offset, slot_name) for index, slot_name in template.static_slots if index > split_index))
 
-    return _auto_parse(data_matrix, template, ignore_dict)
+    return head, tail
 
 
 def _invoice_prep(data_matrix: List[List]):
@@ -207,7 +832,7 @@ def _invoice_prep(data_matrix: List[List]):
     data_matrix[0][1] = data_matrix[0][1].split("_")[1]
 
 
-def _auto_parse(data_matrix, template, ignore_dict={}):
+def _auto_parse(data_matrix, template: _CompiledTemplate, ignore_dict={}):
     """Auto parses data matrix to txt or xml version
 
     This function replaces all $autoparse_xx placeholders
@@ -221,7 +846,7 @@ def _auto_parse(data_matrix, template, ignore_dict={}):
     
     args:
         data_matrix (List[List]): Data matrix from data file
-        template (str): Template string with auto-parse placeholders
+        template (_CompiledTemplate): Compiled template with auto-parse placeholders
         ignore_dict (Dict): Dictionary with static tags that are ignored
                             during auto parsing. This dict should contain
                             ALL tas that are not $autoparse_xx tags.
@@ -229,26 +854,28 @@ def _auto_parse(data_matrix, template, ignore_dict={}):
     returns:
         (str): Auto parsed template string
     """
-    # Get all placeholders
-    placeholders = re.findall(r"\$autoparse_\d{2}", template)
-
-    placelement_map = {}
-    placelement_map.update(ignore_dict)
+    parts = list(template.parts)
 
-    for placeholder in placeholders:
-        pos_x = int(re.findall(r"\d", placeholder)[0])
-        pos_y = int(re.findall(r"\d", placeholder)[1])
+    for index, pos_x, pos_y in template.auto_slots:
         try:
-            placelement_map[placeholder[1:]] = saxutils.escape(data_matrix[pos_x][pos_y])
+            parts[index] = _escape(data_matrix[pos_x][pos_y])
         except IndexError as _:
-            logging.fatal(f"Invalid auto-parse placeholder: {placeholder}")
+            logging.fatal(f"Invalid auto-parse placeholder: $autoparse_{pos_x}{pos_y}")
+            exit(1)
+
+    for index, name in template.static_slots:
+        try:
+            parts[index] = str(ignore_dict[name])
+        except KeyError as e:
+            logging.fatal(f"Invalid auto-parse placeholder: {e}")
             exit(1)
-    
-    try:
-        return string.Template(template).substitute(placelement_map)
-    except KeyError as e:
-        logging.fatal(f"Invalid auto-parse placeholder: {e}")
-        exit(1)
+
+    return "".join(parts)
+
+
+def _escape(value: str) -> str:
+    """Escape &, < and > like xml.sax.saxutils.escape, which imports urllib on start"""
+    return value.replace("&", "&amp;").replace(">", "&gt;").replace("<", "&lt;")
 
 
 def _get_filename(data_matrix: List[List], file_ext: str):
@@ -271,4 +898,39 @@ def get_email_receiver(invoice_content: bytes):
     """Get email receiver name and address from invoice data file"""
     data_matrix = _generate_matrix(invoice_content)
 
-    return data_matrix[1][3], data_matrix[1][7]
\ No newline at end of file
+    return data_matrix[1][3], data_matrix[1][7]
+
+
+def get_receipt_tokens(receipt_content: str) -> FrozenSet[str]:
+    """Get the words of a receipt that are compared with invoice numbers
+
+    args:
+        receipt_content (str): Content of the receipt
+
+    returns:
+        (FrozenSet[str]): Values of the invoice number fields or all alphanumeric words of the receipt
+    """
+    return frozenset(_RECEIPT_INVOICE_FIELD.findall(receipt_content) or _RECEIPT_TOKEN.findall(receipt_content))
+
+
+def get_receipt_invoice_number(receipt_content: str, open_invoice_nrs: Container[str]) -> str or None:
+    """Get the number of the open invoice a receipt refers to
+
+    Only the invoice number field of the receipt ("Rechnung 21003",
+    "Rechnungsnummer: 21003") is compared if it has one. Others are matched
+    by their whole words, so "2100" does not match a receipt for invoice
+    "21003". Receipts with more than one candidate, e.g. an amount that
+    equals another open invoice number, are ambiguous and match no invoice.
+
+    args:
+        receipt_content (str): Content of the receipt
+        open_invoice_nrs (Container[str]): Numbers of open invoices, should be a set or dict
+
+    returns:
+        (str or None): Invoice number of the receipt or None
+    """
+    candidates = {token for token in get_receipt_tokens(receipt_content) if token in open_invoice_nrs}
+    if len(candidates) > 1:
+        logging.warning(f"Ambiguous receipt matches open invoices {', '.join(sorted(candidates))}")
+        return None
+    return next(iter(candidates), None)
@@ -1,13 +1,85 @@
+import enum
+import fcntl
+import functools
+import io
 import logging
 import os
+import re
 import shutil
-import zipfile
-from typing import List
+import sqlite3
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
 
 import config
+import ledger
+import metrics
 
 _CACHE_FOLDER = config.get_cache_folder()
 
+_INDEX_FILE = f"{_CACHE_FOLDER}/index.sqlite"
+
+# Cache file names: Kxxx_xxxxx_invoice.data, Kxxx_xxxxx_invoice.txt, Kxxx_xxxxx_receipt.txt, Kxxx_xxxxx.zip
+_CACHE_FILE_NAME = re.compile(r"(?P<customer>[^_]+)_(?P<invoice>[^_.]+)(?:_(?P<kind>invoice|receipt))?\.(?P<ext>\w+)")
+
+# Index column of a cache file by (kind, extension)
+_INDEX_COLUMNS = {
+    ("invoice", "data"): "data_file",
+    ("invoice", "txt"): "txt_file",
+    ("receipt", "txt"): "receipt_file",
+    (None, "zip"): "zip_file"
+}
+
+# Suffix of stored cache entries by cache/compression
+_SUFFIXES = {None: "", "zlib": ".zz", "lzma": ".xz"}
+
+# Entry column that orders evictions by cache/eviction
+_EVICTION_ORDER = {"lru": "accessed", "ttl": "written"}
+
+# Location of evicted entries in the archive folder, packed entries are located by their daily archive
+_EVICTED = "evicted"
+
+# Values of cache/durability
+_DURABILITY_MODES = ("none", "fsync", "group")
+
+# Daily archives of packed entries: YYYY-MM-DD.zip
+_DAILY_ARCHIVE = re.compile(r"(?P<day>\d{4}-\d{2}-\d{2})\.zip")
+
+_OPERATIONS = metrics.counter("cache_operations", "Cache file reads and writes", ("operation",))
+_BYTES = metrics.counter("cache_bytes", "Size of cache file reads and writes, characters for text files", ("operation",))
+
+_EVICTIONS = metrics.counter("cache_evictions", "Cache entries moved to the archive folder", ("reason",))
+_PACKED = metrics.counter("cache_packed_entries", "Cache entries packed into daily archives")
+_STORED_BYTES = metrics.gauge("cache_stored_bytes", "Size of the stored cache entries", ("location",))
+
+_index_connection = None
+_index_lock = threading.Lock()
+
+# Read times of entries that are not written to the index yet, by file name
+_accessed: Dict[str, float] = {}
+_accessed_lock = threading.Lock()
+
+# Held while entries are moved out of the cache folder
+_eviction_lock = threading.Lock()
+
+# Written files and callbacks waiting for the next commit() with cache/durability group
+_pending_files: List[str] = []
+_pending_callbacks: List[Callable[[], None]] = []
+_commit_lock = threading.Lock()
+
+# Seconds after which temporary files of unfinished writes are removed
+_STALE_TEMP_AGE = 3600
+
+
+class State(enum.Enum):
+    PARSED = 1
+    UPLOADED = 2
+    RECEIPT_RECEIVED = 3
+    MAILED = 4
+    ARCHIVED = 5
+
 
 def _get_cache_filename(filename: str):
     """Get path of a file in cache by file name
@@ -24,20 +96,45 @@ def _get_cache_filename(filename: str):
 def write(filename: str, content: str) -> None:
     """Write a cache file
 
+    The file is stored compressed with cache/compression. Entries over the
+    cache/max_size budget are evicted afterwards.
+
     args:
         filename: Name of the file to write
         content: Content to write
     """
-    open(_get_cache_filename(filename), mode='w').write(content)
+    write_unit({filename: content})
+
+
+def write_unit(files: Dict[str, str]) -> None:
+    """Write related cache files as one unit
+
+    Either all files of the unit replace their previous version or, when
+    writing fails, none of them does.
+
+    args:
+        files (Dict[str, str]): Content by file name, e.g. the data and TXT file of an invoice
+    """
+    _store({filename: content.encode("utf-8") for filename, content in files.items()})
+    for content in files.values():
+        _count("write", len(content))
+    _evict_over_budget()
 
 
 def read(filename: str) -> str:
     """Read a cache file as string
 
+    Evicted and packed files are read from the archive folder.
+
     args:
         filename: Name of the file to read
+
+    raises:
+        FileNotFoundError: File is not in cache
     """
-    return open(_get_cache_filename(filename), mode='r').read()
+    content = _load(filename).decode("utf-8")
+    _count("read", len(content))
+    return content
 
 
 def read_binary(filename: str) -> bytes:
@@ -45,8 +142,13 @@ def read_binary(filename: str) -> bytes:
 
     args:
         filename: Name of the file to read
+
+    raises:
+        FileNotFoundError: File is not in cache
     """
-    return open(_get_cache_filename(filename), mode='rb').read()
+    content = _load(filename)
+    _count("read", len(content))
+    return content
 
 
 def get_invoice_numbers() -> List[str]:
@@ -55,15 +157,8 @@ def get_invoice_numbers() -> List[str]:
     returns:
         List of numbers of all invoices in cache
     """
-    file_list = list(
-        map(
-            lambda filename: filename.split('_')[1],
-            list(
-                filter(
-                    lambda filename: "invoice" in filename, os.listdir(_CACHE_FOLDER))
-            )
-        )
-    )
+    file_list = [row[0] for row in _query(
+        "SELECT invoice_nr FROM invoices WHERE txt_file IS NOT NULL AND state != ?", (State.ARCHIVED.name,))]
     if not file_list:
         logging.info("No cached invoices found. Exiting")
         exit(0)
@@ -79,43 +174,679 @@ def get_invoice_by_number(invoice_number: str) -> str or None:
     returns:
         (str or None): Invoie file name or None when invoice was not found
     """
-    file_list = list(filter(
-        lambda filename: invoice_number in filename and "invoice.txt" in filename, os.listdir(_CACHE_FOLDER)))
-    if len(file_list) < 1:
+    rows = _query("SELECT txt_file FROM invoices WHERE invoice_nr = ? AND txt_file IS NOT NULL", (invoice_number,))
+    if not rows:
         logging.error(f"No cached invoice found with number '{invoice_number}'")
         return None
-    elif len(file_list) > 1:
-        logging.error(f"More than one invoice cached with number '{invoice_number}'")
-        return None
-    return file_list[0]
+    return rows[0][0]
+
+
+def set_state(invoice_number: str, state: State) -> None:
+    """Set the processing state of a cached invoice
 
+    args:
+        invoice_number (str): Invoice number
+        state (State): New state
+    """
+    _query("UPDATE invoices SET state = ? WHERE invoice_nr = ?", (state.name, invoice_number))
 
-def zip_files(invoice_file_name: str, receipt_file_name: str, zip_file_name: str):
+
+def zip_files(invoice_file_name: str, receipt_file_name: str, zip_file_name: str,
+              contents: Optional[Dict[str, str or bytes]] = None) -> bytes:
     """Create a ZIP archive with invoice and receipt
 
+    The archive is built in memory. Entries in contents are written from
+    memory, all others are read from the cache. The archive is only written
+    to the cache when zip/cache is set.
+
     args:
         invoice_file_name (str): File name of the invoice
         receipt_file_name (str): File name of the receipt
         zip_file_name (str): File name of the Zip
+        contents (Dict[str, str or bytes] or None): Contents of entries that are already in memory
+
+    returns:
+        (bytes): Content of the ZIP archive
     """
-    # Create temporary files
-    shutil.copy(_get_cache_filename(invoice_file_name), invoice_file_name)
-    shutil.copy(_get_cache_filename(receipt_file_name), receipt_file_name)
-    with zipfile.ZipFile(_get_cache_filename(zip_file_name), 'w') as zip:
-        zip.write(invoice_file_name)
-        zip.write(receipt_file_name)
+    import zipfile
+    contents = contents or {}
+    zip_config = config.get_zip_config()
+    compression_level = zip_config["compression_level"]
+
+    with io.BytesIO() as buffer_io:
+        with zipfile.ZipFile(buffer_io, 'w',
+                             compression=zipfile.ZIP_STORED if compression_level is None else zipfile.ZIP_DEFLATED,
+                             compresslevel=compression_level) as zip:
+            for file_name in (invoice_file_name, receipt_file_name):
+                zip.writestr(file_name, contents[file_name] if file_name in contents else read_binary(file_name))
+        zip_content = buffer_io.getvalue()
+
+    if zip_config["cache"]:
+        _store({zip_file_name: zip_content})
+        _count("write", len(zip_content))
+        _evict_over_budget()
 
-    # Remove temporary files
-    os.remove(invoice_file_name)
-    os.remove(receipt_file_name)
+    return zip_content
 
 
 def clear(invoice_number: str):
     """Removes all cached files related to an invoice
 
+    The invoice stays in the index with state ARCHIVED. Packed copies stay
+    in their daily archive until cache/archive_max_age.
+
     args:
         invoice_number (str): Invoice number
     """
-    for file in os.listdir(_CACHE_FOLDER):
-        if invoice_number in file:
-            os.remove(_get_cache_filename(file))
\ No newline at end of file
+    rows = _query("SELECT data_file, txt_file, receipt_file, zip_file FROM invoices WHERE invoice_nr = ?",
+                  (invoice_number,))
+    files = [file for file in rows[0] if file] if rows else []
+    for file in files:
+        _discard(file)
+    _transaction([("DELETE FROM entries WHERE filename = ?", (file,)) for file in files] + [
+        ("UPDATE invoices SET data_file = NULL, txt_file = NULL, receipt_file = NULL, zip_file = NULL, "
+         "state = ? WHERE invoice_nr = ?", (State.ARCHIVED.name, invoice_number))])
+
+
+def commit() -> None:
+    """Sync the files written since the last commit and run the callbacks waiting for them
+
+    Only has work with cache/durability group, where a whole batch of
+    invoices is synced at once instead of every file. Called when
+    cache/group_size files are pending and at the end of every run.
+    """
+    with _commit_lock:
+        if not _pending_files and not _pending_callbacks:
+            return
+        files, _pending_files[:] = list(_pending_files), []
+        callbacks, _pending_callbacks[:] = list(_pending_callbacks), []
+        # Synced under the lock, after_commit() must not run callbacks before the files are synced
+        _sync_files(files)
+
+    if files:
+        logging.debug(f"Committed {len(files)} cache files")
+    for callback in callbacks:
+        try:
+            callback()
+        except (Exception, SystemExit) as e:
+            logging.error(f"Failed to run callback after cache commit: {e}")
+
+
+def after_commit(callback: Callable[[], None]) -> None:
+    """Run a callback once the files written so far are synced
+
+    With cache/durability group the callback waits for the next commit(),
+    e.g. to delete the source of an invoice only once its cache files are
+    durable. Otherwise it runs immediately.
+
+    args:
+        callback (Callable[[], None]): Function to run
+    """
+    with _commit_lock:
+        if _pending_files:
+            _pending_callbacks.append(callback)
+            return
+    callback()
+
+
+def maintain() -> None:
+    """Apply the age and size budget of the cache and compact stale invoices
+
+    Entries older than cache/max_age and the entries over cache/max_size are
+    evicted to the archive folder, evicted entries and stale invoices are
+    packed into daily archives and daily archives older than
+    cache/archive_max_age are deleted. Ledger steps older than
+    ledger/max_age are deleted as well.
+    """
+    _remove_stale_temp_files()
+    _evict_expired()
+    _evict_over_budget()
+    compact()
+    _prune_archives()
+    pruned = ledger.prune_steps()
+    if pruned:
+        logging.info(f"Deleted {pruned} ledger steps older than ledger/max_age")
+
+    sizes = dict(_query("SELECT COALESCE(location, 'cache'), SUM(size) FROM entries "
+                        "WHERE location IS NULL OR location = ? GROUP BY location", (_EVICTED,)))
+    for location in ("cache", _EVICTED):
+        _STORED_BYTES.set(sizes.get(location, 0), location=location)
+    _STORED_BYTES.set(sum(os.path.getsize(path) for path, _ in _list_daily_archives()), location="archive")
+
+
+def compact(stale_after: Optional[float] = None) -> int:
+    """Pack evicted entries and the entries of stale invoices into daily archives
+
+    An invoice is stale when none of its files was written or read for
+    stale_after seconds. Entries are packed into <archive_folder>/YYYY-MM-DD.zip
+    of the day they were written and stay readable from there.
+
+    args:
+        stale_after (float or None): Seconds, defaults to cache/compact_after,
+                                     None only packs evicted entries
+
+    returns:
+        (int): Number of packed entries
+    """
+    cache_config = config.get_cache_config()
+    if stale_after is None:
+        stale_after = cache_config["compact_after"]
+
+    sql = "SELECT filename, stored, location, written FROM entries WHERE location = ?"
+    parameters = (_EVICTED,)
+    if stale_after is not None:
+        sql += (" OR (location IS NULL AND invoice_nr IN (SELECT invoice_nr FROM entries WHERE invoice_nr IS NOT NULL "
+                "GROUP BY invoice_nr HAVING MAX(MAX(written, accessed)) < ?))")
+        parameters += (time.time() - stale_after,)
+
+    _flush_accessed()
+    days: Dict[str, List[tuple]] = {}
+    for entry in _query(sql, parameters):
+        days.setdefault(time.strftime("%Y-%m-%d", time.localtime(entry[3])), []).append(entry)
+
+    packed = 0
+    for day, entries in sorted(days.items()):
+        packed += _pack(f"{day}.zip", entries)
+    if packed:
+        logging.info(f"Packed {packed} cache files into {len(days)} daily archives")
+    return packed
+
+
+def _count(operation: str, size: int) -> None:
+    _OPERATIONS.inc(operation=operation)
+    _BYTES.inc(size, operation=operation)
+
+
+def _get_archive_path(name: str) -> str:
+    """Get the path of a file in the archive folder"""
+    return os.path.join(config.get_cache_config()["archive_folder"], name)
+
+
+def _get_stored_path(stored: str, location: Optional[str]) -> str:
+    """Get the path of a stored entry in the cache folder or with the evicted entries"""
+    return _get_cache_filename(stored) if location is None else _get_archive_path(os.path.join(_EVICTED, stored))
+
+
+def _store(files: Dict[str, bytes]) -> None:
+    """Compress and write cache entries to the cache folder and index them
+
+    Every entry is written to a temporary file that replaces the stored
+    file once all entries of the unit were written, so a crash never leaves
+    a partly written entry. The entries are indexed in one transaction.
+    With cache/durability fsync every file is synced before it replaces
+    the stored file, with group they are synced by the next commit().
+    A previous copy of an entry under another name or in the archive
+    folder is removed.
+
+    args:
+        files (Dict[str, bytes]): Uncompressed content by cache file name
+    """
+    cache_config = config.get_cache_config()
+    durability = cache_config["durability"]
+    if durability not in _DURABILITY_MODES:
+        raise ValueError(f"Unknown cache durability '{durability}'")
+
+    staged = []
+    try:
+        for filename, data in files.items():
+            compression = None if filename.endswith(".zip") else cache_config["compression"]
+            if compression not in _SUFFIXES:
+                raise ValueError(f"Unknown cache compression '{compression}'")
+            stored = filename + _SUFFIXES[compression]
+            temp_path = f"{_get_cache_filename(stored)}.{os.getpid()}.{threading.get_ident()}.tmp"
+            staged.append((filename, stored, temp_path))
+            with open(temp_path, "wb") as file:
+                file.write(_compress(data, compression))
+                if durability == "fsync":
+                    file.flush()
+                    os.fsync(file.fileno())
+    except BaseException:
+        for _, _, temp_path in staged:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        raise
+
+    now = time.time()
+    statements = []
+    for filename, stored, temp_path in staged:
+        size = os.path.getsize(temp_path)
+        os.replace(temp_path, _get_cache_filename(stored))
+
+        previous = _query("SELECT stored, location FROM entries WHERE filename = ?", (filename,))
+        if previous and previous[0] != (stored, None) and previous[0][1] in (None, _EVICTED):
+            _remove(*previous[0])
+
+        match = _CACHE_FILE_NAME.fullmatch(filename)
+        statements.append(("INSERT OR REPLACE INTO entries (filename, invoice_nr, stored, location, size, written, "
+                           "accessed) VALUES (?, ?, ?, NULL, ?, ?, ?)",
+                           (filename, match and match.group("invoice"), stored, size, now, now)))
+        index_statement = _index_statement(filename)
+        if index_statement:
+            statements.append(index_statement)
+        else:
+            logging.warning(f"Cache file {filename} does not match any index column")
+
+    if durability == "fsync":
+        _sync_folder()
+    elif durability == "group":
+        with _commit_lock:
+            _pending_files.extend(_get_cache_filename(stored) for _, stored, _ in staged)
+            full = len(_pending_files) >= cache_config["group_size"]
+    _transaction(statements)
+    if durability == "group" and full:
+        commit()
+
+
+def _sync_folder() -> None:
+    """Sync the cache folder, makes the renames of written files durable"""
+    folder = os.open(_CACHE_FOLDER, os.O_RDONLY)
+    try:
+        os.fsync(folder)
+    finally:
+        os.close(folder)
+
+
+def _sync_files(paths: List[str]) -> None:
+    """Sync written files and the cache folder
+
+    One syncfs() of the file system of the cache folder covers all files
+    and the log of the index, every file is synced separately where
+    syncfs() is not available.
+
+    args:
+        paths (List[str]): Paths of the written files
+    """
+    if not paths:
+        return
+    folder = os.open(_CACHE_FOLDER, os.O_RDONLY)
+    try:
+        syncfs = _get_syncfs()
+        if syncfs and syncfs(folder) == 0:
+            return
+        for path in paths + [f"{_INDEX_FILE}-wal"]:
+            try:
+                with open(path, "rb") as file:
+                    os.fsync(file.fileno())
+            except FileNotFoundError as _:
+                # Evicted or written again in the meantime
+                continue
+        os.fsync(folder)
+    finally:
+        os.close(folder)
+
+
+
+@functools.lru_cache(maxsize=None)
+def _get_syncfs() -> Optional[Callable[[int], int]]:
+    """Get syncfs() of the C library or None when it is not available"""
+    # Imported here, only group commits need the C library
+    import ctypes
+    import ctypes.util
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    except OSError as _:
+        return None
+    return getattr(libc, "syncfs", None)
+
+
+def _remove_stale_temp_files() -> None:
+    """Remove the temporary files of writes that did not finish, e.g. of a crashed run"""
+    stale_before = time.time() - _STALE_TEMP_AGE
+    for name in os.listdir(_CACHE_FOLDER):
+        path = _get_cache_filename(name)
+        try:
+            if name.endswith(".tmp") and os.path.getmtime(path) < stale_before:
+                os.remove(path)
+                logging.info(f"Removed unfinished cache file {name}")
+        except FileNotFoundError as _:
+            continue
+
+
+def _load(filename: str) -> bytes:
+    """Read and decompress a cache entry wherever it is stored
+
+    Files cached before the entries were indexed are read from the cache folder.
+    Files that do not have the indexed size count as not in cache.
+
+    args:
+        filename (str): Name of the cache file
+
+    returns:
+        (bytes): Uncompressed content
+
+    raises:
+        FileNotFoundError: File is not in cache
+    """
+    for attempt in range(2):
+        rows = _query("SELECT stored, location, size FROM entries WHERE filename = ?", (filename,))
+        stored, location, size = rows[0] if rows else (filename, None, None)
+        try:
+            if location is None or location == _EVICTED:
+                with open(_get_stored_path(stored, location), "rb") as file:
+                    content = file.read()
+            else:
+                import zipfile
+                with zipfile.ZipFile(_get_archive_path(location)) as archive:
+                    content = archive.read(stored)
+        except (FileNotFoundError, KeyError) as _:
+            # An eviction or compaction may have moved the entry since it was looked up
+            if attempt or not rows:
+                raise FileNotFoundError(f"No cache file {filename}")
+            continue
+
+        if size is not None and len(content) != size:
+            # Indexed before a crash while the file was not synced yet, see commit()
+            raise FileNotFoundError(f"Incomplete cache file {filename}")
+        if rows:
+            # Written to the index before entries are evicted or packed, not one transaction per read
+            with _accessed_lock:
+                _accessed[filename] = time.time()
+        return _decompress(content, stored)
+
+
+def _compress(data: bytes, compression: Optional[str]) -> bytes:
+    level = config.get_cache_config()["compression_level"]
+    if compression == "zlib":
+        return zlib.compress(data, level)
+    if compression == "lzma":
+        import lzma
+        return lzma.compress(data, preset=level)
+    return data
+
+
+def _decompress(content: bytes, stored: str) -> bytes:
+    if stored.endswith(_SUFFIXES["zlib"]):
+        return zlib.decompress(content)
+    if stored.endswith(_SUFFIXES["lzma"]):
+        import lzma
+        return lzma.decompress(content)
+    return content
+
+
+def _remove(stored: str, location: Optional[str]) -> None:
+    """Remove a stored entry from the cache folder or the evicted entries"""
+    try:
+        os.remove(_get_stored_path(stored, location))
+    except FileNotFoundError as _:
+        pass
+
+
+def _discard(filename: str) -> None:
+    """Remove a cache file from where it is stored, packed copies stay in their archive"""
+    rows = _query("SELECT stored, location FROM entries WHERE filename = ?", (filename,))
+    stored, location = rows[0] if rows else (filename, None)
+    if location is None or location == _EVICTED:
+        _remove(stored, location)
+
+
+def _evict_expired() -> None:
+    """Evict the entries of the cache folder older than cache/max_age"""
+    cache_config = config.get_cache_config()
+    if cache_config["max_age"] is None:
+        return
+    column = _EVICTION_ORDER[cache_config["eviction"]]
+    with _eviction_lock:
+        _flush_accessed()
+        _evict(_query(f"SELECT filename, stored FROM entries WHERE location IS NULL AND {column} < ?",
+                      (time.time() - cache_config["max_age"],)), "age")
+
+
+def _evict_over_budget() -> None:
+    """Evict the least recently used (lru) or oldest (ttl) entries until the cache folder fits cache/max_size"""
+    cache_config = config.get_cache_config()
+    max_size = cache_config["max_size"]
+    if max_size is None or _query("SELECT COALESCE(SUM(size), 0) FROM entries WHERE location IS NULL")[0][0] <= max_size:
+        return
+
+    column = _EVICTION_ORDER[cache_config["eviction"]]
+    with _eviction_lock:
+        _flush_accessed()
+        entries = _query(f"SELECT filename, stored, size FROM entries WHERE location IS NULL ORDER BY {column}")
+        size = sum(entry[2] for entry in entries)
+        evicted = []
+        for filename, stored, entry_size in entries:
+            if size <= max_size:
+                break
+            evicted.append((filename, stored))
+            size -= entry_size
+        _evict(evicted, "size")
+
+
+def _evict(entries: List[Tuple[str, str]], reason: str) -> None:
+    """Move entries of the cache folder to the evicted entries in the archive folder
+
+    args:
+        entries (List[Tuple[str, str]]): File and stored names
+        reason (str): age or size
+    """
+    if not entries:
+        return
+    os.makedirs(_get_archive_path(_EVICTED), exist_ok=True)
+    for filename, stored in entries:
+        try:
+            shutil.move(_get_stored_path(stored, None), _get_stored_path(stored, _EVICTED))
+        except FileNotFoundError as _:
+            # Removed or rewritten under another name in the meantime
+            continue
+        _query("UPDATE entries SET location = ? WHERE filename = ? AND stored = ?", (_EVICTED, filename, stored))
+        _EVICTIONS.inc(reason=reason)
+    logging.info(f"Evicted {len(entries)} cache files ({reason})")
+
+
+def _pack(archive_name: str, entries: List[tuple]) -> int:
+    """Append entries to a daily archive and remove them from where they were stored
+
+    Entries are added as they are stored, already compressed entries are not
+    compressed again. Entries that were written again while they were packed
+    stay where they are.
+
+    args:
+        archive_name (str): File name of the daily archive
+        entries (List[tuple]): File name, stored name, location and write time of each entry
+
+    returns:
+        (int): Number of packed entries
+    """
+    import zipfile
+
+    packed = []
+    archive_path = _get_archive_path(archive_name)
+    with _archive_lock():
+        with zipfile.ZipFile(archive_path, "a") as archive:
+            for filename, stored, location, written in entries:
+                try:
+                    with open(_get_stored_path(stored, location), "rb") as file:
+                        content = file.read()
+                except FileNotFoundError as _:
+                    continue
+                # Unique name, a file can be packed again after it was written again on the same day
+                member = f"{int(written * 1000)}/{stored}"
+                compressed = stored.endswith((_SUFFIXES["zlib"], _SUFFIXES["lzma"], ".zip"))
+                archive.writestr(member, content, zipfile.ZIP_STORED if compressed else zipfile.ZIP_DEFLATED)
+                packed.append((filename, stored, location, written, member))
+        if packed and config.get_cache_config()["durability"] != "none":
+            # The entries are removed from where they were stored next
+            with open(archive_path, "rb") as file:
+                os.fsync(file.fileno())
+
+    count = 0
+    for filename, stored, location, written, member in packed:
+        if _execute("UPDATE entries SET location = ?, stored = ? WHERE filename = ? AND stored = ? AND location IS ? "
+                    "AND written = ?", (archive_name, member, filename, stored, location, written)):
+            _remove(stored, location)
+            count += 1
+    _PACKED.inc(count)
+    return count
+
+
+def _prune_archives() -> None:
+    """Delete the daily archives older than cache/archive_max_age with their entries"""
+    max_age = config.get_cache_config()["archive_max_age"]
+    if max_age is None:
+        return
+    oldest_day = time.strftime("%Y-%m-%d", time.localtime(time.time() - max_age))
+    with _archive_lock():
+        for path, day in _list_daily_archives():
+            if day < oldest_day:
+                os.remove(path)
+                _query("DELETE FROM entries WHERE location = ?", (os.path.basename(path),))
+                logging.info(f"Deleted cache archive {path}")
+
+
+def _list_daily_archives() -> Iterator[Tuple[str, str]]:
+    """List the daily archives in the archive folder with their day"""
+    folder = config.get_cache_config()["archive_folder"]
+    if not os.path.isdir(folder):
+        return
+    for name in os.listdir(folder):
+        match = _DAILY_ARCHIVE.fullmatch(name)
+        if match:
+            yield os.path.join(folder, name), match.group("day")
+
+
+@contextmanager
+def _archive_lock():
+    """Lock the archive folder against other processes that pack or prune archives"""
+    os.makedirs(config.get_cache_config()["archive_folder"], exist_ok=True)
+    with open(_get_archive_path(".lock"), "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+
+def _list_cached_files() -> Iterator[Tuple[str, str]]:
+    """List the cache folder with the file name of every stored entry
+
+    returns:
+        (Iterator[Tuple[str, str]]): File and stored names
+    """
+    for stored in os.listdir(_CACHE_FOLDER):
+        filename = stored
+        for suffix in _SUFFIXES.values():
+            if suffix and stored.endswith(suffix):
+                filename = stored[:-len(suffix)]
+        if _CACHE_FILE_NAME.fullmatch(filename):
+            yield filename, stored
+
+
+def _index_statement(filename: str) -> (str, tuple) or None:
+    """Get the statement that adds a cache file to the index
+
+    A file of an archived invoice reopens the invoice.
+
+    args:
+        filename (str): Name of the cache file
+
+    returns:
+        (str, tuple) or None: SQL statement and parameters or None for unknown files
+    """
+    match = _CACHE_FILE_NAME.fullmatch(filename)
+    column = match and _INDEX_COLUMNS.get((match.group("kind"), match.group("ext")))
+    if not column:
+        return None
+
+    return (f"INSERT INTO invoices (invoice_nr, customer_nr, state, {column}) VALUES (?, ?, ?, ?) "
+            f"ON CONFLICT (invoice_nr) DO UPDATE SET customer_nr = excluded.customer_nr, "
+            f"{column} = excluded.{column}, state = CASE WHEN state = ? THEN excluded.state ELSE state END",
+            (match.group("invoice"), match.group("customer"), State.PARSED.name, filename, State.ARCHIVED.name))
+
+
+def _query(sql: str, parameters: tuple = ()) -> List[tuple]:
+    """Run a query on the cache index
+
+    args:
+        sql (str): SQL statement
+        parameters (tuple): Statement parameters
+
+    returns:
+        (List[tuple]): Result rows
+    """
+    with _index_lock:
+        return _get_connection().execute(sql, parameters).fetchall()
+
+
+def _execute(sql: str, parameters: tuple = ()) -> int:
+    """Run a statement on the cache index
+
+    args:
+        sql (str): SQL statement
+        parameters (tuple): Statement parameters
+
+    returns:
+        (int): Number of changed rows
+    """
+    with _index_lock:
+        return _get_connection().execute(sql, parameters).rowcount
+
+
+def _transaction(statements: List[Tuple[str, tuple]]) -> None:
+    """Run statements on the cache index in one transaction
+
+    args:
+        statements (List[Tuple[str, tuple]]): SQL statements and their parameters
+    """
+    with _index_lock, _get_connection() as connection:
+        connection.execute("BEGIN")
+        for statement in statements:
+            connection.execute(*statement)
+
+
+def _flush_accessed() -> None:
+    """Write the read times of entries to the index"""
+    global _accessed
+    with _accessed_lock:
+        accessed, _accessed = _accessed, {}
+    if accessed:
+        _transaction([("UPDATE entries SET accessed = ? WHERE filename = ?", (read_time, filename))
+                      for filename, read_time in accessed.items()])
+
+
+def _get_synchronous() -> str:
+    """Get the SQLite synchronous mode of the databases in the cache folder for cache/durability
+
+    returns:
+        (str): FULL with fsync, NORMAL otherwise
+    """
+    return "FULL" if config.get_cache_config()["durability"] == "fsync" else "NORMAL"
+
+
+def _get_connection() -> sqlite3.Connection:
+    """Get the connection to the cache index, the caller holds _index_lock
+
+    The index is created on first use and filled with the files
+    already in the cache folder.
+
+    returns:
+        (sqlite3.Connection): Connection in autocommit mode
+    """
+    global _index_connection
+    if not _index_connection:
+        _index_connection = sqlite3.connect(_INDEX_FILE, isolation_level=None, check_same_thread=False)
+        # Only cache/durability fsync syncs every transaction, group syncs the log with the next commit()
+        _index_connection.execute("PRAGMA journal_mode = WAL")
+        _index_connection.execute(f"PRAGMA synchronous = {_get_synchronous()}")
+        _index_connection.execute(
+            "CREATE TABLE IF NOT EXISTS invoices ("
+            "invoice_nr TEXT PRIMARY KEY, customer_nr TEXT, state TEXT NOT NULL, "
+            "data_file TEXT, txt_file TEXT, receipt_file TEXT, zip_file TEXT)")
+        # Where each cache file is stored, location is NULL in the cache folder, evicted or a daily archive
+        _index_connection.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "filename TEXT PRIMARY KEY, invoice_nr TEXT, stored TEXT NOT NULL, location TEXT, "
+            "size INTEGER NOT NULL, written REAL NOT NULL, accessed REAL NOT NULL)")
+        _index_connection.execute("CREATE INDEX IF NOT EXISTS entries_location ON entries (location)")
+        if not _index_connection.execute("SELECT 1 FROM invoices LIMIT 1").fetchall():
+            # Index files cached before the index existed
+            for filename, _ in _list_cached_files():
+                statement = _index_statement(filename)
+                if statement:
+                    _index_connection.execute(*statement)
+        if not _index_connection.execute("SELECT 1 FROM entries LIMIT 1").fetchall():
+            # Files cached before the entries were indexed
+            for filename, stored in _list_cached_files():
+                stat = os.stat(_get_cache_filename(stored))
+                match = _CACHE_FILE_NAME.fullmatch(filename)
+                _index_connection.execute(
+                    "INSERT OR IGNORE INTO entries (filename, invoice_nr, stored, location, size, written, accessed) "
+                    "VALUES (?, ?, ?, NULL, ?, ?, ?)",
+                    (filename, match.group("invoice"), stored, stat.st_size, stat.st_mtime, stat.st_mtime))
+    return _index_connection
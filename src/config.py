@@ -1,9 +1,11 @@
 import enum
 import json
 import logging
-from typing import Optional
-
-from pydantic import BaseModel
+import os
+import signal
+import time
+import types
+from typing import Any, Callable, Dict, NamedTuple, Optional, Tuple
 
 
 class Server(enum.Enum):
@@ -20,17 +22,38 @@ _SERVER_CONFIG_PATHS = {
 
 _GENERAL_CONFIG = "./data/config.json"
 
+# Seconds a snapshot is used without checking the config file for changes
+_RECHECK_INTERVAL = 1.0
+
 
-class ServerConfig(BaseModel):
+class ServerConfig(NamedTuple):
     hostname: str
     username: str
     password: str
-    files_in: Optional[str]
-    files_out: Optional[str]
+    port: Optional[int] = None
+    use_ssl: bool = True
+    files_in: Optional[str] = None
+    files_out: Optional[str] = None
+    local_path: Optional[str] = None
+
+
+# Value types of the server config keys, None is allowed for keys that default to None
+_SERVER_CONFIG_TYPES = {"hostname": str, "username": str, "password": str, "port": int, "use_ssl": bool,
+                        "files_in": str, "files_out": str, "local_path": str}
+
+
+class _Snapshot(NamedTuple):
+    stamp: Tuple[int, int, int]
+    checked: float
+    value: Any
+
+
+# Loaded config files by path
+_SNAPSHOTS: Dict[str, _Snapshot] = {}
 
 
 def get_server_config(server):
-    return _load_server_config(_SERVER_CONFIG_PATHS[server])
+    return _load(_SERVER_CONFIG_PATHS[server], _load_server_config)
 
 
 def __getattr__(name):
@@ -77,6 +100,46 @@ def get_template(name: str):
     return get()[f"template_{name}"]
 
 
+def get_cache_config():
+    return get()["cache"]
+
+
+def get_pipeline_config():
+    return get()["pipeline"]
+
+
+def get_ftp_config():
+    return get()["ftp"]
+
+
+def get_transfer_config():
+    return get()["transfer"]
+
+
+def get_async_network_config():
+    return get()["async_network"]
+
+
+def get_zip_config():
+    return get()["zip"]
+
+
+def get_mail_config():
+    return get()["mail"]
+
+
+def get_daemon_config():
+    return get()["daemon"]
+
+
+def get_metrics_config():
+    return get()["metrics"]
+
+
+def get_ledger_config():
+    return get()["ledger"]
+
+
 def get_date_file_format():
     return get()["formats"]["date_file"]
 
@@ -106,10 +169,70 @@ def get_email_sender_name():
 
 
 def get():
+    return _load(_GENERAL_CONFIG, _load_general_config)
+
+
+def reload():
+    """Drop all config snapshots so they are loaded again on next access"""
+    _SNAPSHOTS.clear()
+
+
+def install_reload_handler():
+    """Reload the config files when the process receives SIGHUP"""
+    signal.signal(signal.SIGHUP, lambda signum, frame: reload())
+
+
+def _load(path: str, loader: Callable[[str], Any]):
+    """Get the snapshot of a config file
+
+    The file is only loaded again when its inode, modification time or size
+    changed. The file is checked at most once every _RECHECK_INTERVAL seconds.
+
+    args:
+        path (str): Path of the config file
+        loader (Callable[[str], Any]): Function to load the file
+
+    returns:
+        Loaded config
+    """
+    now = time.monotonic()
+    snapshot = _SNAPSHOTS.get(path)
+    if snapshot and now - snapshot.checked < _RECHECK_INTERVAL:
+        return snapshot.value
+
+    try:
+        stat = os.stat(path)
+    except OSError as _:
+        # Let the loader report the missing file
+        return loader(path)
+
+    stamp = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    if snapshot and snapshot.stamp == stamp:
+        _SNAPSHOTS[path] = snapshot._replace(checked=now)
+        return snapshot.value
+
+    value = loader(path)
+    _SNAPSHOTS[path] = _Snapshot(stamp, now, value)
+    if snapshot:
+        logging.info(f"Reloaded config file {path}")
+    return value
+
+
+def _freeze(value):
+    """Convert parsed JSON into read-only mappings and tuples"""
+    if isinstance(value, dict):
+        return types.MappingProxyType({key: _freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+def _load_general_config(path):
     try:
-        return json.loads(open(_GENERAL_CONFIG).read())
+        with open(path) as config_file:
+            return _freeze(json.load(config_file))
     except IOError as e:
-        logging.fatal(f"Failed to open general config file {_GENERAL_CONFIG}")
+        logging.fatal(f"Failed to open general config file {path}")
         exit(1)
     except json.decoder.JSONDecodeError as e:
         logging.fatal(f"Failed to decode general config file: {e}")
@@ -118,10 +241,44 @@ def get():
 
 def _load_server_config(path):
     try:
-        return ServerConfig(**json.loads(open(path).read()))
+        with open(path) as config_file:
+            return _to_server_config(json.load(config_file))
     except IOError as _:
-        logging.fatal(f"Failed to open general config file {_GENERAL_CONFIG}")
+        logging.fatal(f"Failed to open server config file {path}")
         exit(1)
     except (TypeError, json.decoder.JSONDecodeError) as e:
         logging.fatal(f"Failed to decode server config file: {e}")
-        exit(1)
\ No newline at end of file
+        exit(1)
+
+
+def _to_server_config(values) -> ServerConfig:
+    """Check the types of a decoded server config file
+
+    Unknown keys are ignored, ports may be given as strings of digits.
+
+    args:
+        values: Decoded JSON of the file
+
+    returns:
+        (ServerConfig): Server config
+
+    raises:
+        TypeError: Missing key or value of the wrong type
+    """
+    if not isinstance(values, dict):
+        raise TypeError("Server config must be an object")
+    missing = [name for name in ServerConfig._fields
+               if name not in values and name not in ServerConfig._field_defaults]
+    if missing:
+        raise TypeError(f"Missing keys {', '.join(missing)}")
+
+    fields = {name: values[name] for name in ServerConfig._fields if name in values}
+    if isinstance(fields.get("port"), str) and fields["port"].isdigit():
+        fields["port"] = int(fields["port"])
+    for name, value in fields.items():
+        expected = _SERVER_CONFIG_TYPES[name]
+        if value is None and name in ServerConfig._field_defaults and ServerConfig._field_defaults[name] is None:
+            continue
+        if not isinstance(value, expected) or (expected is int and isinstance(value, bool)):
+            raise TypeError(f"{name} must be of type {expected.__name__}, got {value!r}")
+    return ServerConfig(**fields)
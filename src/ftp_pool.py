@@ -0,0 +1,184 @@
+import ftplib
+import logging
+import threading
+import time
+import types
+from typing import Callable, Dict, List, TypeVar
+
+import config
+import metrics
+
+T = TypeVar("T")
+
+_CONNECT_SECONDS = metrics.histogram("ftp_connect_seconds", "Time to open a FTP connection", ("server",))
+_LOGIN_SECONDS = metrics.histogram("ftp_login_seconds", "Time to log in on a FTP server", ("server",))
+
+# Errors after which a session is dropped and the operation is retried once
+_RECONNECT_ERRORS = (ftplib.error_temp, ftplib.error_reply, EOFError, OSError)
+
+
+class PoolStats(types.SimpleNamespace):
+    """Counters of a FTP connection pool
+
+    Not a dataclass, the dataclasses module would be the slowest import of
+    a cron run that finds nothing to do.
+    """
+
+    def __init__(self, hits: int = 0, logins: int = 0, reconnects: int = 0, noops: int = 0):
+        super().__init__(hits=hits, logins=logins, reconnects=reconnects, noops=noops)
+
+
+class _Session:
+    """Authenticated FTP connection with its current directory"""
+
+    def __init__(self, server_config: config.ServerConfig, conn: ftplib.FTP):
+        self.server_config = server_config
+        self.conn = conn
+        self.home = conn.pwd()
+        self.path = None
+        self.last_used = time.monotonic()
+
+    def cwd(self, path: str or None):
+        """Change into a directory relative to the login directory"""
+        if path == self.path:
+            return
+        if self.path:
+            self.conn.cwd(self.home)
+            self.path = None
+        if path:
+            self.conn.cwd(path)
+        self.path = path
+
+
+class FtpPool:
+    """Pool of authenticated FTP sessions keyed by server config
+
+    Sessions are reused across operations and kept alive with NOOP.
+    Sessions that fail with a temporary error or a dropped socket are
+    replaced by a new session and the operation is retried once.
+    """
+
+    def __init__(self, keepalive: float = 30.0, timeout: float = 60.0, max_idle: int = 4):
+        """
+        args:
+            keepalive (float): Seconds after which an idle session is checked with NOOP
+            timeout (float): Socket timeout of new sessions
+            max_idle (int): Maximum number of idle sessions per server
+        """
+        self.keepalive = keepalive
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.stats = PoolStats()
+        self._idle: Dict[config.ServerConfig, List[_Session]] = {}
+        self._lock = threading.Lock()
+
+    def run(self, server_config: config.ServerConfig, path: str or None, operation: Callable[[ftplib.FTP], T]) -> T:
+        """Run an operation on a pooled session
+
+        The operation may be called a second time on a new session, so it has
+        to create its buffers itself.
+
+        args:
+            server_config (config.ServerConfig): Credentials for server
+            path (str or None): Directory to run the operation in (relative to login directory)
+            operation (Callable[[ftplib.FTP], T]): Operation to run
+
+        returns:
+            Result of the operation
+        """
+        session = self._checkout(server_config)
+        try:
+            try:
+                session.cwd(path)
+                result = operation(session.conn)
+            except _RECONNECT_ERRORS as e:
+                logging.warning(f"Lost session to {server_config.hostname}, reconnecting: {e}")
+                self._close(session)
+                self.stats.reconnects += 1
+                session = None
+                session = self._connect(server_config)
+                session.cwd(path)
+                result = operation(session.conn)
+        except ftplib.error_perm:
+            # Permanent errors are replies to a command, the session is still usable
+            if session:
+                self._checkin(session)
+            raise
+        except BaseException:
+            if session:
+                self._close(session)
+            raise
+
+        self._checkin(session)
+        return result
+
+    def keepalive_all(self):
+        """Send NOOP on all idle sessions and drop the ones that are gone"""
+        with self._lock:
+            sessions = [session for idle in self._idle.values() for session in idle]
+            self._idle.clear()
+        for session in sessions:
+            if self._noop(session):
+                self._checkin(session)
+
+    def close(self):
+        """Close all idle sessions"""
+        with self._lock:
+            sessions = [session for idle in self._idle.values() for session in idle]
+            self._idle.clear()
+        for session in sessions:
+            self._close(session)
+
+    def _checkout(self, server_config: config.ServerConfig) -> _Session:
+        while True:
+            with self._lock:
+                idle = self._idle.get(server_config)
+                session = idle.pop() if idle else None
+            if not session:
+                return self._connect(server_config)
+            if time.monotonic() - session.last_used < self.keepalive or self._noop(session):
+                self.stats.hits += 1
+                return session
+            self.stats.reconnects += 1
+
+    def _checkin(self, session: _Session):
+        session.last_used = time.monotonic()
+        with self._lock:
+            idle = self._idle.setdefault(session.server_config, [])
+            if len(idle) < self.max_idle:
+                idle.append(session)
+                return
+        self._close(session)
+
+    def _connect(self, server_config: config.ServerConfig) -> _Session:
+        logging.info(f"Connecting to server {server_config.hostname}")
+        conn = ftplib.FTP(timeout=self.timeout)
+        with _CONNECT_SECONDS.time(server=server_config.hostname):
+            conn.connect(server_config.hostname, server_config.port or 21)
+        with _LOGIN_SECONDS.time(server=server_config.hostname):
+            conn.login(server_config.username, server_config.password)
+        self.stats.logins += 1
+        return _Session(server_config, conn)
+
+    def _noop(self, session: _Session) -> bool:
+        """Check a session with NOOP
+
+        returns:
+            (bool): If the session is still alive
+        """
+        try:
+            session.conn.voidcmd("NOOP")
+            self.stats.noops += 1
+            return True
+        except _RECONNECT_ERRORS + (ftplib.error_perm,) as _:
+            self._close(session)
+            return False
+
+    @staticmethod
+    def _close(session: _Session):
+        logging.info(f"Disconnecting from server {session.server_config.hostname}")
+        try:
+            session.conn.quit()
+        except (AttributeError,) + _RECONNECT_ERRORS + (ftplib.error_perm,) as _:
+            # Socket is already gone
+            session.conn.close()
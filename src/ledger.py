@@ -0,0 +1,166 @@
+import enum
+import hashlib
+import sqlite3
+import threading
+import time
+from typing import FrozenSet, Iterable, List, Set
+
+import config
+
+_LEDGER_FILE = f"{config.get_cache_folder()}/ledger.sqlite"
+
+_ledger_connection = None
+_ledger_lock = threading.Lock()
+
+
+class Step(enum.Enum):
+    PARSED = 1
+    XML_UPLOADED = 2
+    TXT_UPLOADED = 3
+
+
+def get_digest(content: bytes) -> str:
+    """Get the content hash a data file is recorded with
+
+    args:
+        content (bytes): Content of the data file
+
+    returns:
+        (str): BLAKE2 hash of the content
+    """
+    digest = new_digest()
+    digest.update(content)
+    return digest.hexdigest()
+
+
+def new_digest() -> "hashlib.blake2b":
+    """Get a hash object to compute the content hash of a data file chunk by chunk
+
+    returns:
+        (hashlib.blake2b): Hash object, its hexdigest() of all chunks equals get_digest()
+    """
+    return hashlib.blake2b(digest_size=16)
+
+
+def get_steps(file_name: str, digest: str) -> Set[Step]:
+    """Get the finished processing steps of a data file
+
+    A data file with the same name but a different content has no
+    finished steps.
+
+    args:
+        file_name (str): Name of the data file
+        digest (str): Content hash, see get_digest()
+
+    returns:
+        (Set[Step]): Finished steps
+    """
+    rows = _query("SELECT step FROM steps WHERE file_name = ? AND digest = ?", (file_name, digest))
+    return {Step[row[0]] for row in rows}
+
+
+def record(file_name: str, digest: str, step: Step) -> None:
+    """Record a finished processing step of a data file
+
+    args:
+        file_name (str): Name of the data file
+        digest (str): Content hash, see get_digest()
+        step (Step): Finished step
+    """
+    _query("INSERT OR IGNORE INTO steps (file_name, digest, step, finished) VALUES (?, ?, ?, ?)",
+           (file_name, digest, step.name, time.time()))
+
+
+def prune_steps() -> int:
+    """Delete the steps finished longer than ledger/max_age ago
+
+    returns:
+        (int): Number of deleted steps
+    """
+    max_age = config.get_ledger_config()["max_age"]
+    if max_age is None:
+        return 0
+    oldest = time.time() - max_age
+    count = _query("SELECT COUNT(*) FROM steps WHERE finished < ?", (oldest,))[0][0]
+    if count:
+        _query("DELETE FROM steps WHERE finished < ?", (oldest,))
+    return count
+
+
+def get_remote_file_tokens(host: str, path: str, name: str, size: int, modify: str) -> FrozenSet[str] or None:
+    """Get the recorded words of an unchanged remote file
+
+    args:
+        host (str): Hostname of the server
+        path (str): Directory of the file on the server
+        name (str): Name of the file
+        size (int): Listed size of the file
+        modify (str): Listed modification time of the file
+
+    returns:
+        (FrozenSet[str] or None): Recorded words or None if the file is unknown or changed
+    """
+    rows = _query("SELECT tokens FROM remote_files WHERE host = ? AND path = ? AND name = ? AND size = ? AND modify = ?",
+                  (host, path, name, size, modify))
+    return frozenset(rows[0][0].split()) if rows else None
+
+
+def record_remote_file(host: str, path: str, name: str, size: int, modify: str, tokens: Iterable[str]) -> None:
+    """Record the words of a remote file that was downloaded but not processed
+
+    args:
+        host (str): Hostname of the server
+        path (str): Directory of the file on the server
+        name (str): Name of the file
+        size (int): Listed size of the file
+        modify (str): Listed modification time of the file
+        tokens (Iterable[str]): Words of the file
+    """
+    _query("INSERT OR REPLACE INTO remote_files (host, path, name, size, modify, tokens) VALUES (?, ?, ?, ?, ?, ?)",
+           (host, path, name, size, modify, " ".join(tokens)))
+
+
+def prune_remote_files(host: str, path: str, names: Iterable[str]) -> None:
+    """Forget the remote files of a directory that are no longer listed
+
+    args:
+        host (str): Hostname of the server
+        path (str): Directory on the server
+        names (Iterable[str]): Names of all listed files
+    """
+    listed = set(names)
+    known = _query("SELECT name FROM remote_files WHERE host = ? AND path = ?", (host, path))
+    for (name,) in known:
+        if name not in listed:
+            _query("DELETE FROM remote_files WHERE host = ? AND path = ? AND name = ?", (host, path, name))
+
+
+def _query(sql: str, parameters: tuple = ()) -> List[tuple]:
+    """Run a query on the ledger
+
+    The ledger is created on first use.
+
+    args:
+        sql (str): SQL statement
+        parameters (tuple): Statement parameters
+
+    returns:
+        (List[tuple]): Result rows
+    """
+    global _ledger_connection
+    with _ledger_lock:
+        if not _ledger_connection:
+            _ledger_connection = sqlite3.connect(_LEDGER_FILE, isolation_level=None, check_same_thread=False)
+            # Steps are recorded after the cache commit, see cache._get_synchronous()
+            _ledger_connection.execute("PRAGMA journal_mode = WAL")
+            synchronous = "FULL" if config.get_cache_config()["durability"] == "fsync" else "NORMAL"
+            _ledger_connection.execute(f"PRAGMA synchronous = {synchronous}")
+            _ledger_connection.execute(
+                "CREATE TABLE IF NOT EXISTS steps ("
+                "file_name TEXT NOT NULL, digest TEXT NOT NULL, step TEXT NOT NULL, finished REAL NOT NULL, "
+                "PRIMARY KEY (file_name, digest, step))")
+            _ledger_connection.execute(
+                "CREATE TABLE IF NOT EXISTS remote_files ("
+                "host TEXT NOT NULL, path TEXT NOT NULL, name TEXT NOT NULL, size INTEGER NOT NULL, "
+                "modify TEXT NOT NULL, tokens TEXT NOT NULL, PRIMARY KEY (host, path, name))")
+        return _ledger_connection.execute(sql, parameters).fetchall()
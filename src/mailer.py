@@ -0,0 +1,100 @@
+import collections
+import logging
+import smtplib
+import ssl
+import threading
+import time
+from dataclasses import dataclass, field
+from email.message import Message
+from typing import Deque
+
+import config
+import metrics
+
+_SEND_SECONDS = metrics.histogram("smtp_send_seconds", "Time to send a mail, including reconnects")
+
+# Errors after which the session is dropped and the message is sent again once
+_RECONNECT_ERRORS = (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, OSError)
+
+
+@dataclass
+class MailStats:
+    """Counters of a mail dispatcher"""
+    sent: int = 0
+    logins: int = 0
+    reconnects: int = 0
+    latencies: Deque[float] = field(default_factory=lambda: collections.deque(maxlen=1000))
+
+
+class MailDispatcher:
+    """Sends mails over one authenticated SMTP session
+
+    The session is opened on the first mail and kept until close() is
+    called. A session closed by the server is replaced transparently.
+    """
+
+    def __init__(self, timeout: float = 60.0):
+        """
+        args:
+            timeout (float): Socket timeout of the SMTP session
+        """
+        self.timeout = timeout
+        self.stats = MailStats()
+        self._server = None
+        self._lock = threading.Lock()
+
+    def send(self, sender: str, receiver: str, mail: Message) -> None:
+        """Send a mail immediately
+
+        args:
+            sender (str): Envelope sender address
+            receiver (str): Envelope receiver address
+            mail (Message): Mail to send
+        """
+        with self._lock:
+            self._send(sender, receiver, mail)
+
+    def close(self) -> None:
+        """Close the session"""
+        with self._lock:
+            if self._server:
+                try:
+                    self._server.quit()
+                except _RECONNECT_ERRORS as _:
+                    self._server.close()
+                self._server = None
+
+    def _send(self, sender: str, receiver: str, mail: Message) -> None:
+        start = time.perf_counter()
+        message = mail.as_string()
+        try:
+            self._session().sendmail(sender, receiver, message)
+        except _RECONNECT_ERRORS as e:
+            logging.warning(f"Lost mail session, reconnecting: {e}")
+            if self._server:
+                self._server.close()
+                self._server = None
+            self.stats.reconnects += 1
+            self._session().sendmail(sender, receiver, message)
+        self.stats.sent += 1
+        self.stats.latencies.append(time.perf_counter() - start)
+        _SEND_SECONDS.observe(self.stats.latencies[-1])
+
+    def _session(self) -> smtplib.SMTP:
+        if self._server:
+            return self._server
+
+        email_settings = config.get_server_config(config.Server.EMAIL)
+        if email_settings.use_ssl:
+            server = smtplib.SMTP_SSL(email_settings.hostname, email_settings.port or 465,
+                                      context=ssl.create_default_context(), timeout=self.timeout)
+        else:
+            server = smtplib.SMTP(email_settings.hostname, email_settings.port or 25, timeout=self.timeout)
+        try:
+            server.login(email_settings.username, email_settings.password)
+        except BaseException:
+            server.close()
+            raise
+        self.stats.logins += 1
+        self._server = server
+        return server
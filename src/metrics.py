@@ -0,0 +1,277 @@
+import functools
+import logging
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Tuple
+
+# Default histogram buckets in seconds
+_TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_OPENMETRICS_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+_PROMETHEUS_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Prefix of all metric names
+_NAMESPACE = "payment"
+
+_REGISTRY: List["_Metric"] = []
+_registry_lock = threading.Lock()
+
+
+class _Metric:
+    """Metric family with one value per label combination"""
+    kind = ""
+
+    def __init__(self, name: str, description: str, labels: Tuple[str, ...]):
+        self.name = f"{_NAMESPACE}_{name}"
+        self.description = description
+        self.labels = labels
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if set(labels) != set(self.labels):
+            raise ValueError(f"Metric {self.name} needs the labels {self.labels}, got {tuple(labels)}")
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def _format_labels(self, key: Tuple[str, ...], extra: str = "") -> str:
+        pairs = [f'{label}="{_escape(value)}"' for label, value in zip(self.labels, key)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def samples(self) -> Iterator[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, description: str, labels: Tuple[str, ...]):
+        super().__init__(name, description, labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        """Increase the counter of a label combination"""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            yield f"{self.name}_total{self._format_labels(key)} {_format_value(value)}"
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, description: str, labels: Tuple[str, ...]):
+        super().__init__(name, description, labels)
+        self._values: Dict[Tuple[str, ...], Callable[[], float]] = {}
+
+    def set(self, value: float, **labels) -> None:
+        """Set the gauge of a label combination"""
+        self.set_function(lambda: value, **labels)
+
+    def set_function(self, function: Callable[[], float], **labels) -> None:
+        """Let the gauge of a label combination be read from a function on every scrape"""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = function
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, function in values:
+            yield f"{self.name}{self._format_labels(key)} {_format_value(function())}"
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str, labels: Tuple[str, ...], buckets: Tuple[float, ...]):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # Count per bucket (not cumulative), sum and count by label combination
+        self._values: Dict[Tuple[str, ...], List] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        """Record an observation for a label combination"""
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[0][index] += 1
+                    break
+            counts[1] += value
+            counts[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the run time of a block in seconds"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            values = sorted((key, (list(buckets), total, count)) for key, (buckets, total, count) in self._values.items())
+        for key, (buckets, total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, buckets):
+                cumulative += bucket_count
+                bound_label = 'le="' + _format_value(bound) + '"'
+                yield f"{self.name}_bucket{self._format_labels(key, bound_label)} {cumulative}"
+            yield f"{self.name}_count{self._format_labels(key)} {count}"
+            yield f"{self.name}_sum{self._format_labels(key)} {_format_value(total)}"
+
+
+def counter(name: str, description: str, labels: Tuple[str, ...] = ()) -> Counter:
+    """Create and register a counter
+
+    args:
+        name (str): Name without namespace and _total suffix
+        description (str): Help text
+        labels (Tuple[str, ...]): Label names
+
+    returns:
+        (Counter): Registered counter
+    """
+    return _register(Counter(name, description, labels))
+
+
+def gauge(name: str, description: str, labels: Tuple[str, ...] = ()) -> Gauge:
+    """Create and register a gauge
+
+    args:
+        name (str): Name without namespace
+        description (str): Help text
+        labels (Tuple[str, ...]): Label names
+
+    returns:
+        (Gauge): Registered gauge
+    """
+    return _register(Gauge(name, description, labels))
+
+
+def histogram(name: str, description: str, labels: Tuple[str, ...] = (),
+              buckets: Tuple[float, ...] = _TIME_BUCKETS) -> Histogram:
+    """Create and register a histogram
+
+    args:
+        name (str): Name without namespace
+        description (str): Help text
+        labels (Tuple[str, ...]): Label names
+        buckets (Tuple[float, ...]): Upper bounds of the buckets, +Inf is added
+
+    returns:
+        (Histogram): Registered histogram
+    """
+    return _register(Histogram(name, description, labels, buckets))
+
+
+def render(openmetrics: bool = True) -> str:
+    """Render all registered metrics
+
+    args:
+        openmetrics (bool): OpenMetrics format, else the Prometheus text format
+                            that the node exporter textfile collector reads
+
+    returns:
+        (str): Exposition text
+    """
+    with _registry_lock:
+        registered = list(_REGISTRY)
+
+    lines = []
+    for metric in registered:
+        # The Prometheus text format names counter families with the _total suffix
+        family = metric.name if openmetrics or metric.kind != "counter" else f"{metric.name}_total"
+        lines.append(f"# HELP {family} {metric.description}")
+        lines.append(f"# TYPE {family} {metric.kind}")
+        lines.extend(metric.samples())
+    if openmetrics:
+        lines.append("# EOF")
+    return "\n".join(lines) + "\n"
+
+
+def write_textfile(path: str) -> None:
+    """Write all metrics for the node exporter textfile collector
+
+    The file is replaced atomically so the collector never reads a partial file.
+
+    args:
+        path (str): Path of the .prom file
+    """
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "w") as file:
+        file.write(render(openmetrics=False))
+    os.replace(temp_path, path)
+
+
+def serve(host: str, port: int) -> "http.server.ThreadingHTTPServer":
+    """Serve all metrics over HTTP in a background thread
+
+    Scrapers that accept OpenMetrics get OpenMetrics, all others the
+    Prometheus text format.
+
+    args:
+        host (str): Address to listen on
+        port (int): Port to listen on
+
+    returns:
+        (http.server.ThreadingHTTPServer): Running server, stop it with shutdown()
+    """
+    import http.server
+    server = http.server.ThreadingHTTPServer((host, port), _get_handler())
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logging.info(f"Serving metrics on http://{host}:{server.server_address[1]}/metrics")
+    return server
+
+
+@functools.lru_cache(maxsize=1)
+def _get_handler() -> type:
+    """Get the request handler, http.server is only imported by the daemon"""
+    import http.server
+
+    class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            openmetrics = "application/openmetrics-text" in self.headers.get("Accept", "")
+            body = render(openmetrics).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", _OPENMETRICS_TYPE if openmetrics else _PROMETHEUS_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # Scrapes would flood the service log
+            pass
+
+    return _MetricsHandler
+
+
+def _register(metric: _Metric) -> _Metric:
+    with _registry_lock:
+        _REGISTRY.append(metric)
+    return metric
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
@@ -1,82 +1,197 @@
+import collections
 import ftplib
+import functools
+import hashlib
 import io
+import itertools
 import logging
+import os
 import re
-import smtplib
-import ssl
 import string
-from email import encoders
-from email.mime.base import MIMEBase
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from typing import List
+import threading
+import time
+from typing import AbstractSet, Any, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple, TypeVar
 
-import cache
 import config
+import ftp_pool
+import metrics
+import profiling
+
+# autoparser, cache and ledger are imported by the functions using them, an idle listing of
+# service_cron does not need them
+
+T = TypeVar("T")
+
+_POOL = ftp_pool.FtpPool(**config.get_ftp_config())
+
+# Created on the first mail, smtplib and email are only imported by runs that send mails
+_MAILER: Optional["mailer.MailDispatcher"] = None
+_mailer_lock = threading.Lock()
+
+# Mail templates by path: (mtime_ns, template)
+_MAIL_TEMPLATE_CACHE: Dict[str, Tuple[int, string.Template]] = {}
+
+_TRANSFER_SECONDS = metrics.histogram("ftp_operation_seconds", "Time of FTP operations on an open session",
+                                      ("server", "operation"))
+_TRANSFER_BYTES = metrics.counter("ftp_transferred_bytes", "Bytes transferred over FTP", ("server", "direction"))
+_RESUMED_TRANSFERS = metrics.counter("ftp_resumed_transfers", "Transfers resumed at an offset with REST",
+                                     ("server", "direction"))
+
+# Replies of servers that do not know or implement MLSD
+_NOT_SUPPORTED_REPLIES = ("500", "501", "502")
+
+
+class RemoteFile(NamedTuple):
+    """File listed on a server
+
+    size and modify are None if the server does not support MLSD.
+    """
+    name: str
+    size: Optional[int]
+    modify: Optional[str]
 
 
 def download_invoices(server_config: config.ServerConfig, callback) -> None:
     """Downloads invoices from server
 
+    Invoices are parsed while they are downloaded, malformed invoices are
+    rejected with their first bad row and stay on the server.
+
     args:
         server_config (config.ServerConfig): Credentials for server
-        callback (Callable[[str]]): Callback to process one file
+        callback (Callable[[str, bytes, autoparser.Invoice]]): Callback to process one file
     """
+    def retrieve(remote_file: RemoteFile) -> Optional[Tuple[bytes, "autoparser.Invoice"]]:
+        try:
+            return retrieve_invoice(server_config, server_config.files_out, remote_file)
+        except (IndexError, ValueError) as e:
+            logging.error(f"Failed to process invoice {remote_file.name}: {e}")
+            logging.info(f"Skipped invoice {remote_file.name}")
+            return None
+
     try:
-        logging.info(f"Connecting to server {server_config.hostname}")
-        file_list = _list_files(server_config, config.get_invoice_pattern())
-        with ftplib.FTP(server_config.hostname) as conn:
-            conn.login(server_config.username, server_config.password)
-            conn.cwd(server_config.files_out)
-            for invoice_name in file_list:
-                with io.BytesIO() as buffer_io:
-                    conn.retrbinary(f"RETR {invoice_name}", buffer_io.write)
-                    invoice_content = buffer_io.getvalue()
-                logging.info(f"Downloaded invoice {invoice_name}")
-                logging.info(f"Processing invoice {invoice_name}")
-                if callback(invoice_name, invoice_content):
-                    _del_file(server_config, server_config.files_out, invoice_name)
-                    logging.info(f"Deleted invoice {invoice_name}")
+        remote_files = _list_remote_files(server_config, config.get_invoice_pattern())
+        for remote_file, retrieved in _retrieve_all(server_config, remote_files, retrieve):
+            if not retrieved:
+                continue
+            invoice_name = remote_file.name
+            invoice_content, invoice = retrieved
+            logging.info(f"Downloaded invoice {invoice_name}")
+            logging.info(f"Processing invoice {invoice_name}")
+            with profiling.span("process_invoice", invoice=invoice_name):
+                processed = callback(invoice_name, invoice_content, invoice)
+            if processed:
+                delete_invoice(server_config, invoice_name)
     except ftplib.error_perm as e:
         logging.fatal(f"Server error: {e}")
         exit(0)
 
 
-def download_receipts(server_config: config.ServerConfig, open_invoice_nrs: List[str], callback):
+def delete_invoice(server_config: config.ServerConfig, invoice_name: str) -> None:
+    """Delete a processed invoice from the server once its cache files are durable
+
+    See cache.after_commit().
+
+    args:
+        server_config (config.ServerConfig): Credentials for server
+        invoice_name (str): Name of the invoice file
+    """
+    import cache
+
+    def delete():
+        _del_file(server_config, server_config.files_out, invoice_name)
+        logging.info(f"Deleted invoice {invoice_name}")
+
+    cache.after_commit(delete)
+
+
+def download_receipts(server_config: config.ServerConfig, open_invoice_nrs: Iterable[str], callback):
     """Download receipt based on pending invoices
 
+    Receipts that did not match any open invoice before are not downloaded
+    again while they are unchanged and none of their words is an open
+    invoice number.
+
     args:
         server_config (config.ServerConfig): Credentials for server
-        open_invoice_nrs (List[str]): Cached and pending invoice numbers
+        open_invoice_nrs (Iterable[str]): Cached and pending invoice numbers
         callback (Callable): Callback to process receipt
     """
+    import autoparser
+    import ledger
+
+    open_invoices = frozenset(open_invoice_nrs)
     try:
-        logging.info(f"Connecting to server {server_config.hostname}")
-        file_list = _list_files(server_config, config.get_receipt_pattern())
-        with ftplib.FTP(server_config.hostname) as conn:
-            conn.login(server_config.username, server_config.password)
-            conn.cwd(server_config.files_out)
-            for receipt_name in file_list:
-                # Go through receipt and search for matching invoice number
-                with io.BytesIO() as buffer_io:
-                    conn.retrbinary(f"RETR {receipt_name}", buffer_io.write)
-                    receipt_content = buffer_io.getvalue().decode('utf-8')
-                for open_invoice_nr in open_invoice_nrs:
-                    if open_invoice_nr in receipt_content:
-                        # Delete and process receipt
-                        logging.info(f"Downloaded receipt {receipt_name}")
-                        logging.info(f"Processing receipt {receipt_name}")
-                        if callback(receipt_name, receipt_content, open_invoice_nr):
-                            _del_file(server_config, server_config.files_out, receipt_name)
-                            logging.info(f"Deleted receipt {receipt_name}")
-                        break
-                    else:
-                        logging.info(f"Ignored receipt {receipt_name}")
+        remote_files = _list_remote_files(server_config, config.get_receipt_pattern())
+        ledger.prune_remote_files(server_config.hostname, server_config.files_out,
+                                  [remote_file.name for remote_file in remote_files])
+        changed_files = [remote_file for remote_file in remote_files
+                         if not is_unchanged_unmatched(server_config, remote_file, open_invoices)]
+        skipped = len(remote_files) - len(changed_files)
+        for remote_file, receipt_content in _retrieve_all(server_config, changed_files, functools.partial(
+                _retrieve_remote_file, server_config)):
+            receipt_name = remote_file.name
+            receipt_content = receipt_content.decode('utf-8')
+
+            # Search the receipt for an open invoice number
+            invoice_nr = autoparser.get_receipt_invoice_number(receipt_content, open_invoices)
+            if not invoice_nr:
+                record_unmatched(server_config, remote_file, receipt_content)
+                logging.info(f"Ignored receipt {receipt_name}: no match among {len(open_invoices)} open invoices")
+                continue
+
+            # Delete and process receipt
+            logging.info(f"Downloaded receipt {receipt_name}")
+            logging.info(f"Processing receipt {receipt_name}")
+            with profiling.span("process_receipt", receipt=receipt_name):
+                processed = callback(receipt_name, receipt_content, invoice_nr)
+            if processed:
+                _del_file(server_config, server_config.files_out, receipt_name)
+                logging.info(f"Deleted receipt {receipt_name}")
+        if skipped:
+            logging.info(f"Skipped {skipped} unchanged receipts without an open invoice")
     except ftplib.error_perm as e:
         logging.fatal(f"Server error: {e}")
         exit(0)
 
 
+def is_unchanged_unmatched(server_config: config.ServerConfig, remote_file: RemoteFile,
+                           open_invoices: AbstractSet[str]) -> bool:
+    """Check if a receipt is known to match none of the open invoices
+
+    args:
+        server_config (config.ServerConfig): Credentials for server
+        remote_file (RemoteFile): Listed receipt
+        open_invoices (AbstractSet[str]): Open invoice numbers
+
+    returns:
+        (bool): True if the receipt does not have to be downloaded
+    """
+    import ledger
+
+    if remote_file.size is None or remote_file.modify is None:
+        return False
+    tokens = ledger.get_remote_file_tokens(server_config.hostname, server_config.files_out, *remote_file)
+    return tokens is not None and open_invoices.isdisjoint(tokens)
+
+
+def record_unmatched(server_config: config.ServerConfig, remote_file: RemoteFile, receipt_content: str) -> None:
+    """Remember a receipt that matched none of the open invoices
+
+    args:
+        server_config (config.ServerConfig): Credentials for server
+        remote_file (RemoteFile): Listed receipt
+        receipt_content (str): Content of the receipt
+    """
+    import autoparser
+    import ledger
+
+    if remote_file.size is None or remote_file.modify is None:
+        return
+    ledger.record_remote_file(server_config.hostname, server_config.files_out, *remote_file,
+                              autoparser.get_receipt_tokens(receipt_content))
+
+
 def upload_file(server_config: config.ServerConfig, filename: str, content: bytes) -> None:
     """Upload file to server
 
@@ -86,20 +201,326 @@ def upload_file(server_config: config.ServerConfig, filename: str, content: byte
         content (str): Content of the new file
     """
     try:
-        logging.info(f"Connecting to server {server_config.hostname}")
-        output = io.BytesIO(content)
-
-        with ftplib.FTP(server_config.hostname) as conn:
-            conn.login(server_config.username, server_config.password)
-            conn.cwd(server_config.files_in)
-            conn.storbinary(f"STOR {filename}", output)
+        store_file(server_config, server_config.files_in, filename, content)
         logging.info(f"Uploaded file {filename} to {server_config.hostname}")
-        logging.info(f"Disconnecting from server {server_config.hostname}")
     except ftplib.error_perm as e:
         logging.fatal(f"Server error: {e}")
         exit(0)
 
 
+def get_pool_stats() -> ftp_pool.PoolStats:
+    """Get the counters of the FTP connection pool"""
+    return _POOL.stats
+
+
+def keepalive() -> None:
+    """Check all idle pooled server connections and drop the ones that are gone"""
+    _POOL.keepalive_all()
+
+
+def close() -> None:
+    """Close the mail session and all pooled server connections"""
+    if _MAILER:
+        _MAILER.close()
+    _POOL.close()
+    logging.info(f"FTP pool: {_POOL.stats}")
+    latencies = _MAILER.stats.latencies if _MAILER else None
+    if latencies:
+        logging.info(f"Mail: {_MAILER.stats.sent} sent, {_MAILER.stats.logins} logins, "
+                     f"{_MAILER.stats.reconnects} reconnects, "
+                     f"{sum(latencies) / len(latencies) * 1000:.1f} ms average latency")
+
+
+def retrieve_file(server_config: config.ServerConfig, path: str, filename: str,
+                  size: Optional[int] = None, modify: Optional[str] = None,
+                  parser: Optional["autoparser.DataFileParser"] = None) -> bytes:
+    """Download a file from server
+
+    A download that is interrupted by a lost session continues at the
+    received offset with REST on the new session. Files of at least
+    transfer/resume_min_size bytes are received into a partial file in
+    the cache folder, so a later run continues them as well.
+    Server errors are raised to the caller.
+
+    args:
+        server_config (config.ServerConfig): Credentials for server
+        path (str): Path to the file to download e.g. out/AP17bGribi
+        filename (str): Name of the file to download
+        size (int): Size of the file from the listing, if known
+        modify (str): Modification time of the file from the listing, if known
+        parser (autoparser.DataFileParser): Parser that is fed every received block,
+                                            its errors abort the download
+
+    returns:
+        (bytes): Content of the file
+
+    raises:
+        IndexError, ValueError: Raised by the parser
+    """
+    transfer_config = config.get_transfer_config()
+    partial_path = None
+    if size is not None and size >= transfer_config["resume_min_size"]:
+        partial_path = _get_partial_path(server_config, path, filename, modify)
+
+    with open(partial_path, "a+b") if partial_path else io.BytesIO() as buffer:
+        parsed = 0
+
+        def receive(block: bytes):
+            nonlocal parsed
+            buffer.write(block)
+            _TRANSFER_BYTES.inc(len(block), server=server_config.hostname, direction="download")
+            if parser:
+                parser.feed(block)
+                parsed += len(block)
+
+        def retrieve(conn: ftplib.FTP) -> None:
+            nonlocal parsed
+            offset = buffer.seek(0, io.SEEK_END)
+            if size is not None and offset > size:
+                offset = _restart(buffer)
+            if parser and parsed != offset:
+                # Feed what an earlier run received into the partial file, or start over
+                parser.reset()
+                buffer.seek(0)
+                parser.feed(buffer.read(offset))
+                parsed = offset
+            if offset:
+                logging.info(f"Resuming download of {filename} at byte {offset}")
+                _RESUMED_TRANSFERS.inc(server=server_config.hostname, direction="download")
+            try:
+                conn.retrbinary(f"RETR {filename}", receive, transfer_config["blocksize"], rest=offset or None)
+            except ftplib.error_perm as e:
+                if not offset or not str(e).startswith(_NOT_SUPPORTED_REPLIES):
+                    raise
+                logging.warning(f"{server_config.hostname} does not support REST, downloading {filename} again")
+                _restart(buffer)
+                if parser:
+                    parser.reset()
+                    parsed = 0
+                conn.retrbinary(f"RETR {filename}", receive, transfer_config["blocksize"])
+
+        try:
+            with profiling.span("ftp_retrieve", file=filename):
+                _POOL.run(server_config, path, _timed(server_config, "retrieve", retrieve))
+        except (IndexError, ValueError):
+            # Rejected by the parser, a partial file would only be rejected again
+            if partial_path:
+                os.remove(partial_path)
+            raise
+        buffer.seek(0)
+        content = buffer.read()
+
+    if partial_path:
+        os.remove(partial_path)
+    return content
+
+
+def retrieve_invoice(server_config: config.ServerConfig, path: str,
+                     remote_file: RemoteFile) -> Tuple[bytes, "autoparser.Invoice"]:
+    """Download a data file and parse it while it is received
+
+    Server errors are raised to the caller.
+
+    args:
+        server_config (config.ServerConfig): Credentials for server
+        path (str): Path to the file to download e.g. out/AP17bGribi
+        remote_file (RemoteFile): Listed data file
+
+    returns:
+        (bytes, autoparser.Invoice): Content of the file and the parsed invoice
+
+    raises:
+        IndexError, ValueError: Data file is malformed, see autoparser.parse()
+    """
+    import autoparser
+
+    parser = autoparser.DataFileParser()
+    content = retrieve_file(server_config, path, remote_file.name, remote_file.size, remote_file.modify, parser)
+    return content, parser.close()
+
+
+def store_file(server_config: config.ServerConfig, path: str, filename: str, content: bytes) -> None:
+    """Upload a file to server
+
+    Files of at least transfer/resume_min_size bytes are uploaded as
+    <filename>.part and renamed once complete, so the file never appears
+    partially on the server. An upload that is interrupted by a lost
+    session continues at the size of the partial file on the new session.
+    Server errors are raised to the caller.
+
+    args:
+        server_config (config.ServerConfig): Credentials for server
+        path (str): Path to upload the file to e.g. in/AP17bGribi
+        filename (str): Name of the new file on the server
+        content (bytes): Content of the new file
+    """
+    transfer_config = config.get_transfer_config()
+    if len(content) < transfer_config["resume_min_size"]:
+        with profiling.span("ftp_store", file=filename):
+            _POOL.run(server_config, path, _timed(server_config, "store", lambda conn: conn.storbinary(
+                f"STOR {filename}", io.BytesIO(content), transfer_config["blocksize"],
+                callback=_count_upload(server_config))))
+        return
+
+    partial_name = f"{filename}.part"
+    attempts = itertools.count()
+
+    def store(conn: ftplib.FTP) -> None:
+        offset = _get_remote_size(conn, partial_name) if next(attempts) else 0
+        if offset is None or offset > len(content):
+            offset = 0
+        if offset:
+            logging.info(f"Resuming upload of {filename} at byte {offset}")
+            _RESUMED_TRANSFERS.inc(server=server_config.hostname, direction="upload")
+        with io.BytesIO(content) as file:
+            file.seek(offset)
+            conn.storbinary(f"STOR {partial_name}", file, transfer_config["blocksize"],
+                            callback=_count_upload(server_config), rest=offset or None)
+        conn.rename(partial_name, filename)
+
+    with profiling.span("ftp_store", file=filename):
+        _POOL.run(server_config, path, _timed(server_config, "store", store))
+
+
+def delete_file(server_config: config.ServerConfig, path: str, filename: str) -> None:
+    """Delete a file from server
+
+    Server errors are raised to the caller.
+
+    args:
+        server_config (config.ServerConfig): Credentials for server
+        path (str): Path to the file to delete e.g. out/AP17bGribi
+        filename (str): Name of the file to delete
+    """
+    _POOL.run(server_config, path, _timed(server_config, "delete", lambda conn: conn.delete(filename)))
+
+
+def list_remote_files(server_config: config.ServerConfig, regex_pattern: str) -> List[RemoteFile]:
+    """List files with size and modification time in the files out directory that match a regex pattern
+
+    Uses MLSD and falls back to NLST for servers that do not support it.
+    Server errors are raised to the caller.
+
+    args:
+         server_config (config.ServerConfig): Credentials for server
+         regex_pattern (str): Regex pattern that files have to match
+
+    returns:
+        List[RemoteFile]: Matching files
+    """
+    def list_directory(conn: ftplib.FTP) -> List[RemoteFile]:
+        try:
+            return [RemoteFile(name, int(facts["size"]) if "size" in facts else None, facts.get("modify"))
+                    for name, facts in conn.mlsd() if facts.get("type", "file") == "file"]
+        except ftplib.error_perm as e:
+            if not str(e).startswith(_NOT_SUPPORTED_REPLIES):
+                raise
+            return [RemoteFile(name, None, None) for name in conn.nlst()]
+
+    pattern = _compile_pattern(regex_pattern)
+    remote_files = [remote_file for remote_file in _POOL.run(server_config, server_config.files_out,
+                                                               _timed(server_config, "list", list_directory))
+                    if pattern.match(remote_file.name)]
+
+    if not remote_files:
+        logging.info(f"No files found on {server_config.hostname} that match '{regex_pattern}'")
+    return remote_files
+
+
+def _timed(server_config: config.ServerConfig, operation_name: str,
+           operation: Callable[[ftplib.FTP], Any]) -> Callable[[ftplib.FTP], Any]:
+    """Wrap a pool operation to record its run time, without connecting and logging in"""
+    def timed(conn: ftplib.FTP):
+        with _TRANSFER_SECONDS.time(server=server_config.hostname, operation=operation_name):
+            return operation(conn)
+    return timed
+
+
+def _count_upload(server_config: config.ServerConfig) -> Callable[[bytes], None]:
+    """Get a storbinary callback that counts the uploaded bytes"""
+    return lambda block: _TRANSFER_BYTES.inc(len(block), server=server_config.hostname, direction="upload")
+
+
+def _retrieve_all(server_config: config.ServerConfig, remote_files: List[RemoteFile],
+                  retrieve: Callable[[RemoteFile], T]) -> Iterator[Tuple[RemoteFile, T]]:
+    """Download files of the files out directory in listing order
+
+    Up to transfer/parallel files are downloaded at once over separate
+    sessions while the caller processes the previous ones.
+
+    args:
+        server_config (config.ServerConfig): Credentials for server
+        remote_files (List[RemoteFile]): Files to download
+        retrieve (Callable[[RemoteFile], T]): Downloads one file
+
+    returns:
+        (Iterator[Tuple[RemoteFile, T]]): Listed file and the result of retrieve
+    """
+    parallel = config.get_transfer_config()["parallel"]
+    if parallel <= 1 or len(remote_files) <= 1:
+        for remote_file in remote_files:
+            yield remote_file, retrieve(remote_file)
+        return
+
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(parallel, thread_name_prefix="ftp-transfer") as executor:
+        files = iter(remote_files)
+        pending = collections.deque((remote_file, executor.submit(retrieve, remote_file))
+                                    for remote_file in itertools.islice(files, parallel))
+        while pending:
+            remote_file, future = pending.popleft()
+            next_file = next(files, None)
+            if next_file:
+                pending.append((next_file, executor.submit(retrieve, next_file)))
+            yield remote_file, future.result()
+
+
+def _retrieve_remote_file(server_config: config.ServerConfig, remote_file: RemoteFile) -> bytes:
+    """Download a listed file of the files out directory"""
+    return retrieve_file(server_config, server_config.files_out, remote_file.name,
+                         remote_file.size, remote_file.modify)
+
+
+def _get_partial_path(server_config: config.ServerConfig, path: str, filename: str, modify: Optional[str]) -> str:
+    """Get the path of the partial file of a download and drop partial files older than transfer/partial_max_age
+
+    The modification time is part of the name, so a changed file on the
+    server is downloaded from the start.
+    """
+    partial_folder = os.path.join(config.get_cache_folder(), "partial")
+    os.makedirs(partial_folder, exist_ok=True)
+
+    expired = time.time() - config.get_transfer_config()["partial_max_age"]
+    with os.scandir(partial_folder) as entries:
+        for entry in entries:
+            if entry.name.endswith(".part") and entry.stat().st_mtime < expired:
+                os.remove(entry.path)
+
+    key = f"{server_config.hostname}:{server_config.port}/{path}/{filename}/{modify}"
+    return os.path.join(partial_folder, hashlib.blake2b(key.encode(), digest_size=16).hexdigest() + ".part")
+
+
+def _restart(buffer: io.IOBase) -> int:
+    """Discard the received part of a download"""
+    buffer.seek(0)
+    buffer.truncate()
+    return 0
+
+
+def _get_remote_size(conn: ftplib.FTP, filename: str) -> Optional[int]:
+    """Get the size of a file on the server, None if it does not exist or SIZE is not supported"""
+    try:
+        conn.voidcmd("TYPE I")
+        return conn.size(filename)
+    except ftplib.error_perm as _:
+        return None
+
+
+@functools.lru_cache(maxsize=16)
+def _compile_pattern(regex_pattern: str) -> re.Pattern:
+    return re.compile(regex_pattern)
+
+
 def _del_file(server_config: config.ServerConfig, path: str, filename: str) -> None:
     """Delete file from server
 
@@ -109,16 +530,13 @@ def _del_file(server_config: config.ServerConfig, path: str, filename: str) -> N
         filename (str): Name of the file to delete
     """
     try:
-        with ftplib.FTP(server_config.hostname) as conn:
-            conn.login(server_config.username, server_config.password)
-            conn.cwd(path)
-            conn.delete(filename)
+        delete_file(server_config, path, filename)
     except ftplib.error_perm as e:
         logging.fatal(f"Server error: {e}")
         exit(0)
 
 
-def _list_files(server_config: config.ServerConfig, regex_pattern: str) -> List[str]:
+def _list_remote_files(server_config: config.ServerConfig, regex_pattern: str) -> List[RemoteFile]:
     """List files in a certain directory on server that match a certain regex pattern
 
     args:
@@ -126,20 +544,10 @@ def _list_files(server_config: config.ServerConfig, regex_pattern: str) -> List[
          regex_pattern (str): Regex pattern that files have to match
 
     returns:
-        List[str]: Filenames of matching files
+        List[RemoteFile]: Matching files
     """
     try:
-        with ftplib.FTP(server_config.hostname) as conn:
-            conn.login(server_config.username, server_config.password)
-            conn.cwd(server_config.files_out)
-            file_list = list(filter(
-                lambda i: re.match(regex_pattern, i) and
-                          re.match(regex_pattern, i).string == i,
-                conn.nlst()))
-
-            if not file_list:
-                logging.info(f"No files found on {server_config.hostname} that match '{regex_pattern}'")
-            return file_list
+        return list_remote_files(server_config, regex_pattern)
     except ftplib.error_perm as e:
         logging.fatal(f"Server error: {e}")
         exit(0)
@@ -148,34 +556,68 @@ def _list_files(server_config: config.ServerConfig, regex_pattern: str) -> List[
 def send_mail(sender: str, sender_name: str,
               receiver: str, receiver_name: str,
               invoice_number: str, receipt_date: str,
-              receipt_time: str, zip_file_name: str):
+              receipt_time: str, zip_file_name: str,
+              zip_content: bytes = None):
     """Sends an email with an attached zip to the customer
 
     args:
         invoice_number (str): Number of the invoice
         zip_file_name (str): Name of the zip file
+        zip_content (bytes): Content of the zip file, read from cache if not given
     """
-    message = string.Template(open(config.get_mail_template()).read()).substitute(
+    from email import encoders
+    from email.mime.base import MIMEBase
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+
+    import cache
+
+    message = _get_mail_template().substitute(
         receiver_name=receiver_name, sender_name=sender_name,
         invoice_number=invoice_number,
         time=receipt_time, date=receipt_date,
         server=config.get_server_config(config.Server.PAYMENT).hostname)
 
-    email_settings = config.get_server_config(config.Server.EMAIL)
-    with smtplib.SMTP_SSL(email_settings.hostname, 465, context=ssl.create_default_context()) as server:
-        server.login(email_settings.username, email_settings.password)
+    mail = MIMEMultipart()
+    mail['From'] = f"{sender_name} <{sender}>"
+    mail['To'] = f"{receiver_name} <{receiver}>"
+    mail['Subject'] = f"Erfolgte Verarbeitung Rechnung {invoice_number}"
+    mail.attach(MIMEText(message, 'plain'))
+
+    zip_attachment = MIMEBase('application', "octet-stream")
+    zip_attachment.set_payload(zip_content if zip_content is not None else cache.read_binary(zip_file_name))
+    encoders.encode_base64(zip_attachment)
+    zip_attachment.add_header('Content-Disposition', f'attachment; filename="{zip_file_name}"')
+
+    mail.attach(zip_attachment)
+
+    with profiling.span("smtp_send", invoice=invoice_number):
+        _get_mailer().send(sender, receiver, mail)
 
-        mail = MIMEMultipart()
-        mail['From'] = f"{sender_name} <{sender}>"
-        mail['To'] = f"{receiver_name} <{receiver}>"
-        mail['Subject'] = f"Erfolgte Verarbeitung Rechnung {invoice_number}"
-        mail.attach(MIMEText(message, 'plain'))
 
-        zip_attachment = MIMEBase('application', "octet-stream")
-        zip_attachment.set_payload(cache.read_binary(zip_file_name))
-        encoders.encode_base64(zip_attachment)
-        zip_attachment.add_header('Content-Disposition', f'attachment; filename="{zip_file_name}"')
+def _get_mailer() -> "mailer.MailDispatcher":
+    """Get the mail dispatcher, created on first use"""
+    global _MAILER
+    with _mailer_lock:
+        if not _MAILER:
+            import mailer
+            _MAILER = mailer.MailDispatcher(**config.get_mail_config())
+        return _MAILER
 
-        mail.attach(zip_attachment)
 
-        server.sendmail(sender, receiver, mail.as_string())
+def _get_mail_template() -> string.Template:
+    """Get the mail template, only read again when the file changed
+
+    returns:
+        (string.Template): Mail template
+    """
+    template_file = config.get_mail_template()
+    mtime = os.stat(template_file).st_mtime_ns
+    cached = _MAIL_TEMPLATE_CACHE.get(template_file)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    with open(template_file) as template:
+        compiled = string.Template(template.read())
+    _MAIL_TEMPLATE_CACHE[template_file] = (mtime, compiled)
+    return compiled
@@ -0,0 +1,161 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import random
+import re
+import select
+import struct
+import threading
+import time
+from typing import Callable, FrozenSet, List, Optional
+
+import config
+import network
+
+# inotify events of files that were completely written or moved into a directory
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+
+# Header of a struct inotify_event: wd, mask, cookie, len
+_INOTIFY_EVENT = struct.Struct("iIII")
+
+
+class Poller:
+    """Decides when a directory on a server has to be processed
+
+    The files out directory is listed every poll_min_interval seconds while
+    new or changed files keep appearing. While it is idle the interval grows
+    by poll_backoff per listing up to max_interval. If the server config
+    has a local_path, file events in it end the wait immediately.
+    """
+
+    def __init__(self, server: config.Server, pattern: Callable[[], str], max_interval: Callable[[], float]):
+        """
+        args:
+            server (config.Server): Server to poll
+            pattern (Callable[[], str]): Returns the regex pattern of the files to poll for
+            max_interval (Callable[[], float]): Returns the maximum interval, the directory is
+                                                processed at least this often
+        """
+        self.server = server
+        self._pattern = pattern
+        self._max_interval = max_interval
+        self._listed: Optional[FrozenSet[network.RemoteFile]] = None
+        self._last_due = 0.0
+        self._interval = 0.0
+        self._woken = threading.Event()
+        self._closed = threading.Event()
+
+        local_path = config.get_server_config(server).local_path
+        if local_path:
+            threading.Thread(target=self._watch, args=(local_path,), name=f"watch-{server.name.lower()}",
+                             daemon=True).start()
+
+    def is_due(self) -> bool:
+        """List the directory and check if it has to be processed
+
+        returns:
+            (bool): True if files appeared or changed since the last listing,
+                    wake() was called or it was not processed for max_interval
+        """
+        daemon_config = config.get_daemon_config()
+        woken = self._woken.is_set()
+        self._woken.clear()
+
+        try:
+            listed = frozenset(network.list_remote_files(config.get_server_config(self.server), self._pattern()))
+        except Exception as e:
+            logging.error(f"Failed to poll {self.server.name.lower()} server: {e}")
+            listed = self._listed
+        appeared = listed is not None and (self._listed is None or not listed <= self._listed)
+        self._listed = listed
+
+        now = time.monotonic()
+        if appeared or woken:
+            self._interval = daemon_config["poll_min_interval"]
+        else:
+            self._interval = min(max(self._interval, daemon_config["poll_min_interval"]) * daemon_config["poll_backoff"],
+                                 self._max_interval())
+
+        if appeared or woken or now - self._last_due >= self._max_interval():
+            self._last_due = now
+            return True
+        return False
+
+    def wait(self) -> None:
+        """Wait for the current interval, wake() or a file event"""
+        jitter = config.get_daemon_config()["jitter"]
+        self._woken.wait(self._interval * (1 + random.uniform(-jitter, jitter)))
+
+    def wake(self) -> None:
+        """End the current wait and let the next is_due() return True"""
+        self._woken.set()
+
+    def close(self) -> None:
+        """Stop watching the local path and end the current wait"""
+        self._closed.set()
+        self._woken.set()
+
+    def _watch(self, local_path: str) -> None:
+        try:
+            inotify = _Inotify(local_path)
+        except OSError as e:
+            logging.warning(f"Cannot watch {local_path}, polling only: {e}")
+            return
+
+        logging.info(f"Watching {local_path} for {self.server.name.lower()} files")
+        with inotify:
+            while not self._closed.is_set():
+                pattern = re.compile(self._pattern())
+                if any(pattern.match(name) for name in inotify.read(timeout=1.0)):
+                    self._woken.set()
+
+
+class _Inotify:
+    """Minimal inotify binding for file events in one directory (Linux only)"""
+
+    def __init__(self, path: str):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError("inotify is not available")
+
+        self._fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        if libc.inotify_add_watch(self._fd, os.fsencode(path), _IN_CLOSE_WRITE | _IN_MOVED_TO) < 0:
+            errno = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(errno, os.strerror(errno), path)
+
+    def read(self, timeout: float) -> List[str]:
+        """Wait for events
+
+        args:
+            timeout (float): Seconds to wait at most
+
+        returns:
+            (List[str]): Names of the files with events
+        """
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return []
+
+        names = []
+        while True:
+            try:
+                buffer = os.read(self._fd, 65536)
+            except BlockingIOError:
+                return names
+            offset = 0
+            while offset < len(buffer):
+                _, _, _, name_length = _INOTIFY_EVENT.unpack_from(buffer, offset)
+                offset += _INOTIFY_EVENT.size
+                names.append(os.fsdecode(buffer[offset:offset + name_length].rstrip(b"\0")))
+                offset += name_length
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        os.close(self._fd)
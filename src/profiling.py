@@ -0,0 +1,203 @@
+import io
+import json
+import logging
+import os
+import stat
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import FrozenSet, List, Optional
+
+# Environment variable with the profiling modes, same format as --profile
+_PROFILE_ENV = "PAYMENT_PROFILE"
+
+_MODES = frozenset({"cpu", "memory", "spans"})
+
+# Number of functions and allocation sites in the reports
+_REPORT_LIMIT = 30
+
+# Finished spans while span recording is enabled, None while disabled
+_spans: Optional[List[dict]] = None
+_spans_lock = threading.Lock()
+
+# CPU profilers of the threads started while the cpu mode is enabled, None while disabled
+_thread_profilers: Optional[List["cProfile.Profile"]] = None
+_thread_profilers_lock = threading.Lock()
+
+
+def get_modes(argv: List[str] = None) -> FrozenSet[str]:
+    """Get the profiling modes of this run
+
+    Modes are read from --profile or the PAYMENT_PROFILE environment variable
+    as a comma separated list of cpu, memory and spans, or all.
+    --profile without a value enables cpu and spans.
+
+    args:
+        argv (List[str]): Command line arguments, defaults to sys.argv
+
+    returns:
+        (FrozenSet[str]): Enabled modes
+
+    raises:
+        ValueError: Unknown mode
+    """
+    argv = sys.argv[1:] if argv is None else argv
+    if not any(argument.startswith("--profile") for argument in argv) and not os.environ.get(_PROFILE_ENV):
+        return frozenset()
+
+    # Imported here, the services only need it for --profile
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--profile", nargs="?", const="cpu,spans", default=os.environ.get(_PROFILE_ENV, ""),
+                        help="Profile the run: comma separated cpu, memory, spans or all")
+    value = parser.parse_known_args(argv)[0].profile
+
+    modes = {mode.strip() for mode in value.split(",") if mode.strip()}
+    if "all" in modes:
+        return _MODES
+    if modes - _MODES:
+        raise ValueError(f"Unknown profiling modes {', '.join(sorted(modes - _MODES))}")
+    return frozenset(modes)
+
+
+@contextmanager
+def profile(name: str, modes: FrozenSet[str]):
+    """Profile a block and write the reports when it ends
+
+    Reports are named after the service and the start time and written
+    next to the log file (the file stderr is redirected to) or into the
+    working directory:
+
+        cpu: <name>-<time>.pstats and the top functions by cumulative time in <name>-<time>-cpu.txt,
+             including the threads started while profiling
+        memory: top allocation sites in <name>-<time>-memory.txt
+        spans: one JSON object per span in <name>-<time>-spans.jsonl
+
+    args:
+        name (str): Name of the service
+        modes (FrozenSet[str]): Enabled modes, see get_modes()
+    """
+    global _spans, _thread_profilers
+    if not modes:
+        yield
+        return
+
+    # Imported here to keep them out of the start of unprofiled runs
+    import cProfile
+    import tracemalloc
+
+    prefix = os.path.join(_get_report_dir(), f"{name}-{time.strftime('%Y%m%d-%H%M%S')}")
+    profiler = cProfile.Profile() if "cpu" in modes else None
+    if profiler and sys.version_info < (3, 12):
+        # Python 3.12 profiles all threads with one profiler, older versions only the calling thread
+        _thread_profilers = []
+        threading.setprofile(_profile_thread)
+    if "memory" in modes:
+        tracemalloc.start()
+    if "spans" in modes:
+        _spans = []
+    if profiler:
+        profiler.enable()
+
+    try:
+        yield
+    finally:
+        if profiler:
+            profiler.disable()
+            threading.setprofile(None)
+            with _thread_profilers_lock:
+                thread_profilers, _thread_profilers = _thread_profilers or [], None
+            _write_cpu_report(profiler, thread_profilers, prefix)
+        if "memory" in modes:
+            _write_memory_report(tracemalloc.take_snapshot(), prefix)
+            tracemalloc.stop()
+        if "spans" in modes:
+            with _spans_lock:
+                spans, _spans = _spans, None
+            _write_spans(spans, prefix)
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """Time a block as a span if span recording is enabled
+
+    args:
+        name (str): Name of the span, e.g. process_invoice
+        attributes: Values to record with the span, e.g. the file name
+    """
+    if _spans is None:
+        yield
+        return
+
+    start = time.time()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record = {"span": name, "start": round(start, 6), "seconds": round(time.perf_counter() - started, 6),
+                  "thread": threading.current_thread().name, **attributes}
+        with _spans_lock:
+            if _spans is not None:
+                _spans.append(record)
+
+
+def _profile_thread(frame, event: str, arg) -> None:
+    """Start a CPU profiler in a new thread, installed with threading.setprofile()"""
+    import cProfile
+    profiler = cProfile.Profile()
+    with _thread_profilers_lock:
+        if _thread_profilers is None:
+            sys.setprofile(None)
+            return
+        _thread_profilers.append(profiler)
+    profiler.enable()
+
+
+def _get_report_dir() -> str:
+    """Get the directory of the log file stderr is redirected to or the working directory"""
+    try:
+        log_file = os.readlink("/proc/self/fd/2")
+        if stat.S_ISREG(os.stat(log_file).st_mode):
+            return os.path.dirname(log_file)
+    except OSError as _:
+        pass
+    return os.getcwd()
+
+
+def _write_cpu_report(profiler: "cProfile.Profile", thread_profilers: List["cProfile.Profile"], prefix: str) -> None:
+    import pstats
+    with io.StringIO() as report:
+        stats = pstats.Stats(profiler, stream=report)
+        for thread_profiler in thread_profilers:
+            stats.add(thread_profiler)
+        stats.dump_stats(f"{prefix}.pstats")
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(_REPORT_LIMIT)
+        with open(f"{prefix}-cpu.txt", "w") as file:
+            file.write(report.getvalue())
+    logging.info(f"Wrote CPU profile of {len(thread_profilers) + 1} threads to {prefix}.pstats")
+
+
+def _write_memory_report(snapshot: "tracemalloc.Snapshot", prefix: str) -> None:
+    import tracemalloc
+    statistics = snapshot.statistics("lineno")
+    with open(f"{prefix}-memory.txt", "w") as file:
+        current, peak = tracemalloc.get_traced_memory()
+        file.write(f"Current {current / 1024:.1f} KiB, peak {peak / 1024:.1f} KiB\n\n")
+        for statistic in statistics[:_REPORT_LIMIT]:
+            file.write(f"{statistic}\n")
+    logging.info(f"Wrote memory report {prefix}-memory.txt")
+
+
+def _write_spans(spans: List[dict], prefix: str) -> None:
+    with open(f"{prefix}-spans.jsonl", "w") as file:
+        for record in spans:
+            file.write(json.dumps(record) + "\n")
+
+    totals = {}
+    for record in spans:
+        count, seconds = totals.get(record["span"], (0, 0.0))
+        totals[record["span"]] = (count + 1, seconds + record["seconds"])
+    for name, (count, seconds) in sorted(totals.items()):
+        logging.info(f"Span {name}: {count} times, {seconds:.3f} s total, {seconds / count * 1000:.1f} ms average")
+    logging.info(f"Wrote {len(spans)} spans to {prefix}-spans.jsonl")
@@ -0,0 +1,202 @@
+import argparse
+import concurrent.futures
+import glob
+import logging
+import os
+import re
+import tarfile
+import zipfile
+from typing import Iterator, List, NamedTuple, Optional, Tuple
+
+import coloredlogs
+
+import autoparser
+import config
+
+# Number of data files rendered per worker task
+_CHUNK_SIZE = 64
+
+# Data files of at least this many bytes are streamed once per format instead of parsed into memory once
+_STREAM_MIN_SIZE = 16 * 1024 * 1024
+
+
+class BatchSummary(NamedTuple):
+    succeeded: int
+    failed: List[Tuple[str, str]]
+
+
+class _Job(NamedTuple):
+    name: str
+    path: Optional[str]
+    content: Optional[bytes]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render local invoice data files with the auto-parser")
+    parser.add_argument("source", help="Directory, glob pattern or tar/zip archive with data files")
+    parser.add_argument("target", help="Directory to write the rendered files to")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of worker processes")
+    parser.add_argument("--formats", nargs="+", default=["txt", "xml"], help="Formats to render")
+    args = parser.parse_args()
+
+    summary = render_batch(args.source, args.target, tuple(args.formats), args.workers)
+    for name, error in summary.failed:
+        logging.error(f"Failed to render {name}: {error}")
+    logging.info(f"Rendered {summary.succeeded} data files, {len(summary.failed)} failed")
+    exit(1 if summary.failed else 0)
+
+
+def render_batch(source: str, target: str, formats=("txt", "xml"), workers: int = None) -> BatchSummary:
+    """Render all data files of a directory, glob or archive on all cores
+
+    Only files whose name matches the invoice pattern are rendered.
+
+    args:
+        source (str): Directory, glob pattern or tar/zip archive with data files
+        target (str): Directory to write the rendered files to
+        formats (Iterable[str]): Formats to render
+        workers (int): Number of worker processes, defaults to the number of CPUs
+
+    returns:
+        (BatchSummary): Number of rendered data files and failures by file name
+    """
+    os.makedirs(target, exist_ok=True)
+    workers = workers or os.cpu_count()
+    pattern = re.compile(config.get_invoice_pattern())
+    jobs = (job for job in _read_source(source) if pattern.fullmatch(os.path.basename(job.name)))
+
+    succeeded = 0
+    failed = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        for chunk in _chunks(jobs, _CHUNK_SIZE):
+            # Only keep a few chunks in flight so archives are not read into memory at once
+            if len(pending) >= workers * 2:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    chunk_succeeded, chunk_failed = future.result()
+                    succeeded += chunk_succeeded
+                    failed += chunk_failed
+            pending.add(executor.submit(_render_chunk, chunk, target, formats))
+
+        for future in concurrent.futures.as_completed(pending):
+            chunk_succeeded, chunk_failed = future.result()
+            succeeded += chunk_succeeded
+            failed += chunk_failed
+
+    return BatchSummary(succeeded, failed)
+
+
+def _read_source(source: str) -> Iterator[_Job]:
+    """Get the data files of a directory, glob pattern or archive
+
+    Files of a directory or glob are read by the workers, files of an
+    archive are read here.
+
+    args:
+        source (str): Directory, glob pattern or tar/zip archive
+
+    returns:
+        (Iterator[_Job]): Data files
+    """
+    if os.path.isdir(source):
+        for entry in os.scandir(source):
+            if entry.is_file():
+                yield _Job(entry.name, entry.path, None)
+    elif os.path.isfile(source) and zipfile.is_zipfile(source):
+        with zipfile.ZipFile(source) as archive:
+            for info in archive.infolist():
+                if not info.is_dir():
+                    yield _Job(info.filename, None, archive.read(info))
+    elif os.path.isfile(source) and tarfile.is_tarfile(source):
+        with tarfile.open(source) as archive:
+            for member in archive:
+                if member.isfile():
+                    yield _Job(member.name, None, archive.extractfile(member).read())
+    else:
+        for path in glob.iglob(source):
+            if os.path.isfile(path):
+                yield _Job(os.path.basename(path), path, None)
+
+
+def _chunks(jobs: Iterator[_Job], size: int) -> Iterator[List[_Job]]:
+    chunk = []
+    for job in jobs:
+        chunk.append(job)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _render_chunk(chunk: List[_Job], target: str, formats) -> Tuple[int, List[Tuple[str, str]]]:
+    """Render data files in a worker process
+
+    args:
+        chunk (List[_Job]): Data files to render
+        target (str): Directory to write the rendered files to
+        formats (Iterable[str]): Formats to render
+
+    returns:
+        (int, List[Tuple[str, str]]): Number of rendered files and failures by file name
+    """
+    succeeded = 0
+    failed = []
+    for job in chunk:
+        try:
+            _render_job(job, target, formats)
+            succeeded += 1
+        except (Exception, SystemExit) as e:
+            failed.append((job.name, str(e) or type(e).__name__))
+    return succeeded, failed
+
+
+def _render_job(job: _Job, target: str, formats) -> None:
+    """Render one data file to all formats into the target directory
+
+    Data files that fit into memory are parsed once for all formats,
+    larger files are streamed once per format. All files written for the
+    data file are removed if it is invalid.
+    """
+    written = []
+    try:
+        if job.content is not None or os.path.getsize(job.path) < _STREAM_MIN_SIZE:
+            if job.content is None:
+                with open(job.path, "rb") as data_file:
+                    content = data_file.read()
+            else:
+                content = job.content
+            for file_name, rendered in autoparser.render(content, formats).values():
+                written.append(os.path.join(target, file_name))
+                with open(written[-1], "w") as output:
+                    output.write(rendered)
+        else:
+            for file_format in formats:
+                with open(job.path, encoding="utf-8") as data_file:
+                    file_name, chunks = autoparser.render_stream(data_file, file_format)
+                    written.append(os.path.join(target, file_name))
+                    with open(written[-1], "w") as output:
+                        output.writelines(chunks)
+    except BaseException:
+        for path in written:
+            try:
+                os.remove(path)
+            except FileNotFoundError as _:
+                pass
+        raise
+
+
+def logging_init():
+    """Initialize logging
+
+    Specifies which file to use for logging and sets color logging
+    for better comprehension
+    """
+    logging.basicConfig(level=logging.DEBUG)
+    coloredlogs.install()
+
+
+if __name__ == "__main__":
+    logging_init()
+    main()
@@ -0,0 +1,78 @@
+import ftplib
+import importlib
+import logging
+import sys
+
+import config
+import metrics
+import network
+import profiling
+
+# Services that can be run, by command line argument
+_SERVICES = ("parse", "zip")
+
+
+def main(service_name: str):
+    """Run a service once if its server has matching files
+
+    The service module and the cache are only imported when there is
+    work. The session of the listing stays in the pool and is reused by
+    the service.
+
+    args:
+        service_name (str): parse or zip
+    """
+    try:
+        if not has_work(service_name):
+            return
+        import cache
+
+        service = importlib.import_module(f"service_{service_name}")
+        service.logging_init()
+        with profiling.profile(f"service_{service_name}", profiling.get_modes()):
+            service.run()
+            cache.maintain()
+    finally:
+        network.close()
+        textfile_dir = config.get_metrics_config()["textfile_dir"]
+        if textfile_dir:
+            metrics.write_textfile(f"{textfile_dir}/service_{service_name}.prom")
+
+
+def has_work(service_name: str) -> bool:
+    """Check if a service has any files to process
+
+    Service ZIP only has work while invoices are open, the cache is only
+    checked once receipts are listed and exits the run otherwise.
+
+    args:
+        service_name (str): parse or zip
+
+    returns:
+        (bool): If matching files are listed on the server of the service
+    """
+    if service_name == "parse":
+        server_config = config.get_server_config(config.Server.CUSTOMER)
+        pattern = config.get_invoice_pattern()
+    else:
+        server_config = config.get_server_config(config.Server.PAYMENT)
+        pattern = config.get_receipt_pattern()
+
+    try:
+        remote_files = network.list_remote_files(server_config, pattern)
+    except ftplib.error_perm as e:
+        logging.fatal(f"Server error: {e}")
+        exit(0)
+    if remote_files and service_name == "zip":
+        import cache
+        cache.get_invoice_numbers()
+    return bool(remote_files)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in _SERVICES:
+        print(f"usage: {sys.argv[0]} {{{','.join(_SERVICES)}}} [--profile [MODES]]", file=sys.stderr)
+        exit(2)
+    logging.basicConfig(level=logging.DEBUG)
+    config.install_reload_handler()
+    main(sys.argv[1])
@@ -0,0 +1,137 @@
+import logging
+import random
+import signal
+import threading
+import time
+from typing import Callable
+
+import coloredlogs
+
+import cache
+import config
+import metrics
+import network
+import poller
+import service_parse
+import service_zip
+
+
+def main():
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+
+    metrics_config = config.get_metrics_config()
+    metrics_server = metrics.serve(metrics_config["host"], metrics_config["port"]) if metrics_config["port"] else None
+
+    invoices = poller.Poller(config.Server.CUSTOMER, config.get_invoice_pattern,
+                             lambda: config.get_daemon_config()["parse_interval"])
+    receipts = poller.Poller(config.Server.PAYMENT, config.get_receipt_pattern,
+                             lambda: config.get_daemon_config()["zip_interval"])
+    cycles = [
+        # Parsed invoices may match receipts that are already waiting
+        _start_polled_cycle("parse", service_parse.run, invoices, stop, on_run=receipts.wake),
+        _start_polled_cycle("zip", service_zip.run, receipts, stop),
+        _start_cycle("keepalive", network.keepalive, lambda: config.get_ftp_config()["keepalive"], stop),
+        _start_cycle("cache", cache.maintain, lambda: config.get_cache_config()["maintain_interval"], stop)
+    ]
+    logging.info("Daemon started")
+
+    # Wait with a timeout so signals are handled promptly
+    while not stop.wait(1):
+        pass
+
+    logging.info("Stopping daemon after the running cycles")
+    for polled in (invoices, receipts):
+        polled.close()
+    for cycle in cycles:
+        cycle.join()
+    network.close()
+    if metrics_server:
+        metrics_server.shutdown()
+    logging.info("Daemon stopped")
+
+
+def _start_polled_cycle(name: str, function: Callable[[], None], polled: poller.Poller, stop: threading.Event,
+                        on_run: Callable[[], None] = None) -> threading.Thread:
+    """Run a function in its own thread whenever a poller finds work, until stop is set
+
+    args:
+        name (str): Name of the cycle for logging
+        function (Callable[[], None]): Function to run
+        polled (poller.Poller): Poller of the directory the function processes
+        stop (threading.Event): Ends the cycle after the current run
+        on_run (Callable[[], None]): Called after every run
+
+    returns:
+        (threading.Thread): Started cycle thread
+    """
+    def cycle():
+        while not stop.is_set():
+            if polled.is_due():
+                _run(name, function)
+                if on_run:
+                    on_run()
+            polled.wait()
+
+    thread = threading.Thread(target=cycle, name=f"cycle-{name}")
+    thread.start()
+    return thread
+
+
+def _start_cycle(name: str, function: Callable[[], None], interval: Callable[[], float],
+                 stop: threading.Event) -> threading.Thread:
+    """Run a function repeatedly in its own thread until stop is set
+
+    The next run starts interval seconds after the last one started,
+    varied by daemon/jitter. Runs of one cycle never overlap. A failing
+    run is logged and does not stop the cycle.
+
+    args:
+        name (str): Name of the cycle for logging
+        function (Callable[[], None]): Function to run
+        interval (Callable[[], float]): Returns the current interval in seconds
+        stop (threading.Event): Ends the cycle after the current run
+
+    returns:
+        (threading.Thread): Started cycle thread
+    """
+    def cycle():
+        while not stop.is_set():
+            started = time.monotonic()
+            _run(name, function)
+
+            jitter = config.get_daemon_config()["jitter"]
+            delay = interval() * (1 + random.uniform(-jitter, jitter))
+            stop.wait(max(0.0, delay - (time.monotonic() - started)))
+
+    thread = threading.Thread(target=cycle, name=f"cycle-{name}")
+    thread.start()
+    return thread
+
+
+def _run(name: str, function: Callable[[], None]) -> None:
+    """Run a cycle function once, a failing run is logged"""
+    try:
+        function()
+    except SystemExit as _:
+        # Services exit when there is nothing to do or on fatal server errors, both already logged
+        pass
+    except Exception as e:
+        logging.exception(f"Cycle {name} failed: {e}")
+
+
+def logging_init():
+    """Initialize logging
+
+    Specifies which file to use for logging and sets color logging
+    for better comprehension
+    """
+    logging.basicConfig(level=logging.DEBUG)
+    coloredlogs.install()
+
+
+if __name__ == "__main__":
+    logging_init()
+    config.install_reload_handler()
+    main()
@@ -1,17 +1,64 @@
+import ftplib
+import functools
 import logging
-import coloredlogs
+import queue
+import threading
+from typing import Callable, Dict, Iterable, List, Tuple
 
 import autoparser
 import cache
 import config
+import ledger
+import metrics
 import network
+import profiling
+
+
+# Marks the end of a stage queue
+_STOP = None
+
+_QUEUE_DEPTH = metrics.gauge("pipeline_queue_depth", "Invoices waiting for a pipeline stage", ("stage",))
+
+# Ledger step of the upload of each format
+_UPLOAD_STEPS = {
+    "xml": ledger.Step.XML_UPLOADED,
+    "txt": ledger.Step.TXT_UPLOADED
+}
 
 
 def main():
-    network.download_invoices(config.get_server_config(config.Server.CUSTOMER), process_invoice)
+    try:
+        run()
+        cache.maintain()
+    finally:
+        network.close()
+        textfile_dir = config.get_metrics_config()["textfile_dir"]
+        if textfile_dir:
+            metrics.write_textfile(f"{textfile_dir}/service_parse.prom")
+
+
+def run():
+    """Processes all invoices on the customer server once
+
+    Server connections stay open for the next run. Invoices still waiting
+    for the cache commit are deleted at the end of the run.
+    """
+    try:
+        if config.get_async_network_config()["enabled"]:
+            # Imported here, only the async mode needs asyncio
+            import asyncio
+            import async_network
+            asyncio.run(async_network.download_invoices(
+                config.get_server_config(config.Server.CUSTOMER), process_invoice_async))
+        elif config.get_pipeline_config()["enabled"]:
+            run_pipeline()
+        else:
+            network.download_invoices(config.get_server_config(config.Server.CUSTOMER), process_invoice)
+    finally:
+        cache.commit()
 
 
-def process_invoice(invoice_file_name: str, invoice_content: bytes) -> bool:
+def process_invoice(invoice_file_name: str, invoice_content: bytes, invoice: autoparser.Invoice = None) -> bool:
     """Processes an invoice
 
         1) Cache data receipt
@@ -19,38 +66,270 @@ def process_invoice(invoice_file_name: str, invoice_content: bytes) -> bool:
         3) Cache TXT receipt
         4) Upload XML to payment server
 
+        Steps recorded in the ledger for the same file name and content
+        are skipped.
+
         args:
             invoice_file_name (str): Invoice file name
             invoice_content (bytes): Invoice content
+            invoice (autoparser.Invoice): Invoice parsed while it was downloaded
 
         returns:
             (bool): If invoice got processed successfully
         """
+    digest = invoice.digest if invoice else ledger.get_digest(invoice_content)
+    formats = get_pending_uploads(invoice_file_name, digest)
+    if not formats:
+        logging.info(f"Skipped parsing and upload of invoice {invoice_file_name}, already processed")
+        return True
+
+    rendered = parse_invoice(invoice_file_name, invoice_content, invoice)
+    if not rendered:
+        return False
+    _record_step(invoice_file_name, digest, ledger.Step.PARSED)
+
+    upload_invoice(rendered, invoice_file_name, digest, formats)
+    return True
+
+
+async def process_invoice_async(invoice_file_name: str, invoice_content: bytes,
+                                invoice: autoparser.Invoice = None) -> bool:
+    """Async version of process_invoice
+
+    Rendering runs in the executor, the XML and TXT files are uploaded concurrently.
+
+    args:
+        invoice_file_name (str): Invoice file name
+        invoice_content (bytes): Invoice content
+        invoice (autoparser.Invoice): Invoice parsed while it was downloaded
+
+    returns:
+        (bool): If invoice got processed successfully
+    """
+    import asyncio
+    import async_network
+
+    digest = invoice.digest if invoice else ledger.get_digest(invoice_content)
+    formats = get_pending_uploads(invoice_file_name, digest)
+    if not formats:
+        logging.info(f"Skipped parsing and upload of invoice {invoice_file_name}, already processed")
+        return True
+
+    rendered = await asyncio.get_running_loop().run_in_executor(
+        None, parse_invoice, invoice_file_name, invoice_content, invoice)
+    if not rendered:
+        return False
+    _record_step(invoice_file_name, digest, ledger.Step.PARSED)
+
+    payment_server = config.get_server_config(config.Server.PAYMENT)
+
+    async def upload(file_format: str):
+        file_name, file_content = rendered[file_format]
+        await async_network.store_file(payment_server, payment_server.files_in, file_name, file_content.encode())
+        _record_step(invoice_file_name, digest, _UPLOAD_STEPS[file_format])
+
+    await asyncio.gather(*(upload(file_format) for file_format in formats))
+    cache.set_state(rendered["txt"][0].split("_")[1], cache.State.UPLOADED)
+    return True
+
+
+def get_pending_uploads(invoice_file_name: str, digest: str) -> Tuple[str, ...]:
+    """Get the formats of an invoice that were not uploaded yet
+
+    args:
+        invoice_file_name (str): Invoice file name
+        digest (str): Content hash of the invoice, see ledger.get_digest()
+
+    returns:
+        (Tuple[str, ...]): Formats to upload, empty when the invoice was processed
+    """
+    steps = ledger.get_steps(invoice_file_name, digest)
+    return tuple(file_format for file_format, step in _UPLOAD_STEPS.items() if step not in steps)
+
+
+def parse_invoice(invoice_file_name: str, invoice_content: bytes,
+                  invoice: autoparser.Invoice = None) -> Dict[str, Tuple[str, str]] or None:
+    """Parses an invoice and caches the data and TXT file
+
+    args:
+        invoice_file_name (str): Invoice file name
+        invoice_content (bytes): Invoice content
+        invoice (autoparser.Invoice): Invoice parsed while it was downloaded, parsed from the content if not given
+
+    returns:
+        (Dict[str, Tuple[str, str]] or None): File name and content by format
+                                              or None when the invoice is invalid
+    """
     # Parse both XML and TXT files
     try:
-        txt_file_name, txt_file_content = autoparser.parse_text(invoice_content)
+        with profiling.span("parse_invoice", invoice=invoice_file_name):
+            if invoice:
+                rendered = autoparser.render_invoice(invoice, ("txt", "xml"))
+            else:
+                rendered = autoparser.render(invoice_content, ("txt", "xml"))
+        txt_file_name, txt_file_content = rendered["txt"]
         logging.info(f"Parsed file {txt_file_name} with auto-parser")
-        xml_file_name, xml_file_content = autoparser.parse_xml(invoice_content)
+        xml_file_name, _ = rendered["xml"]
         logging.info(f"Parsed file {xml_file_name} with auto-parser")
-    except IndexError as e:
+    except (IndexError, ValueError) as e:
         logging.error(f"Failed to process invoice {invoice_file_name}: {e}")
         logging.info(f"Skipped invoice {invoice_file_name}")
-        return False
+        return None
 
-    # Cache data file for later usage
+    # Cache data file for later usage and TXT file to ZIP later, together so a crash never leaves one of them
     data_file_name = txt_file_name.replace(".txt", ".data")
-    cache.write(data_file_name, invoice_content.decode('utf-8'))
+    cache.write_unit({data_file_name: invoice_content.decode('utf-8'), txt_file_name: txt_file_content})
     logging.info(f"Cached file {data_file_name}")
-
-    # Cache TXT file to ZIP later
-    cache.write(txt_file_name, txt_file_content)
     logging.info(f"Cached file {txt_file_name}")
 
-    # Upload XML and TXT files to the payment server
-    network.upload_file(config.get_server_config(config.Server.PAYMENT), xml_file_name, xml_file_content.encode())
-    network.upload_file(config.get_server_config(config.Server.PAYMENT), txt_file_name, txt_file_content.encode())
+    return rendered
 
-    return True
+
+def upload_invoice(rendered: Dict[str, Tuple[str, str]], invoice_file_name: str, digest: str,
+                   formats: Iterable[str] = ("xml", "txt")) -> None:
+    """Uploads the parsed XML and TXT files to the payment server
+
+    Every finished upload is recorded in the ledger.
+
+    args:
+        rendered (Dict[str, Tuple[str, str]]): File name and content by format
+        invoice_file_name (str): Invoice file name
+        digest (str): Content hash of the invoice, see ledger.get_digest()
+        formats (Iterable[str]): Formats to upload
+    """
+    payment_server = config.get_server_config(config.Server.PAYMENT)
+    for file_format in formats:
+        file_name, file_content = rendered[file_format]
+        network.upload_file(payment_server, file_name, file_content.encode())
+        _record_step(invoice_file_name, digest, _UPLOAD_STEPS[file_format])
+    cache.set_state(rendered["txt"][0].split("_")[1], cache.State.UPLOADED)
+
+
+def _record_step(invoice_file_name: str, digest: str, step: ledger.Step) -> None:
+    """Record a finished step of an invoice in the ledger once its cache files are committed
+
+    An invoice whose cache files were lost in a crash is processed again
+    instead of being skipped as processed, see cache.after_commit().
+
+    args:
+        invoice_file_name (str): Invoice file name
+        digest (str): Content hash of the invoice, see ledger.get_digest()
+        step (ledger.Step): Finished step
+    """
+    cache.after_commit(functools.partial(ledger.record, invoice_file_name, digest, step))
+
+
+def run_pipeline() -> None:
+    """Processes all invoices with concurrent download, parse and upload stages
+
+    The stages are joined by bounded queues. An invoice is only deleted on the
+    customer server after its files were uploaded, failed invoices stay on the
+    server.
+    """
+    pipeline_config = config.get_pipeline_config()
+    customer_server = config.get_server_config(config.Server.CUSTOMER)
+    payment_server = config.get_server_config(config.Server.PAYMENT)
+
+    try:
+        file_list = network.list_remote_files(customer_server, config.get_invoice_pattern())
+    except ftplib.error_perm as e:
+        logging.fatal(f"Server error: {e}")
+        exit(0)
+
+    names = queue.Queue()
+    for remote_file in file_list:
+        names.put((remote_file.name, remote_file))
+    downloaded = queue.Queue(maxsize=pipeline_config["queue_size"])
+    parsed = queue.Queue(maxsize=pipeline_config["queue_size"])
+    processed = []
+
+    def download(invoice_name: str, remote_file: network.RemoteFile):
+        invoice_content, invoice = network.retrieve_invoice(customer_server, customer_server.files_out, remote_file)
+        logging.info(f"Downloaded invoice {invoice_name}")
+        downloaded.put((invoice_name, invoice_content, invoice))
+
+    def parse(invoice_name: str, invoice_content: bytes, invoice: autoparser.Invoice):
+        logging.info(f"Processing invoice {invoice_name}")
+        digest = invoice.digest
+        formats = get_pending_uploads(invoice_name, digest)
+        if not formats:
+            logging.info(f"Skipped parsing and upload of invoice {invoice_name}, already processed")
+            parsed.put((invoice_name, digest, formats, None))
+            return
+
+        rendered = parse_invoice(invoice_name, invoice_content, invoice)
+        if rendered:
+            _record_step(invoice_name, digest, ledger.Step.PARSED)
+            parsed.put((invoice_name, digest, formats, rendered))
+
+    def upload(invoice_name: str, digest: str, formats: Tuple[str, ...], rendered: Dict[str, Tuple[str, str]]):
+        for file_format in formats:
+            file_name, file_content = rendered[file_format]
+            network.store_file(payment_server, payment_server.files_in, file_name, file_content.encode())
+            _record_step(invoice_name, digest, _UPLOAD_STEPS[file_format])
+            logging.info(f"Uploaded file {file_name} to {payment_server.hostname}")
+        if rendered:
+            cache.set_state(rendered["txt"][0].split("_")[1], cache.State.UPLOADED)
+        # Only delete the source once all uploads succeeded and its cache files are durable
+        network.delete_invoice(customer_server, invoice_name)
+        processed.append(invoice_name)
+
+    for stage, source in (("download", names), ("parse", downloaded), ("upload", parsed)):
+        _QUEUE_DEPTH.set_function(source.qsize, stage=stage)
+
+    downloaders = _start_stage(pipeline_config["download_workers"], names, download)
+    parsers = _start_stage(pipeline_config["parse_workers"], downloaded, parse)
+    uploaders = _start_stage(pipeline_config["upload_workers"], parsed, upload)
+
+    _stop_stage(downloaders, names)
+    _stop_stage(parsers, downloaded)
+    _stop_stage(uploaders, parsed)
+
+    logging.info(f"Processed {len(processed)} of {len(file_list)} invoices")
+
+
+def _start_stage(worker_count: int, source: queue.Queue, handler: Callable) -> List[threading.Thread]:
+    """Start the workers of a pipeline stage
+
+    Each worker takes argument tuples from the source queue and passes them
+    to the handler until it gets _STOP. A failing item is logged and skipped.
+
+    args:
+        worker_count (int): Number of workers
+        source (queue.Queue): Queue to take items from
+        handler (Callable): Function to process one item
+
+    returns:
+        (List[threading.Thread]): Started workers
+    """
+    def work():
+        while True:
+            item = source.get()
+            if item is _STOP:
+                return
+            try:
+                with profiling.span(f"pipeline_{handler.__name__}", invoice=item[0]):
+                    handler(*item)
+            except (Exception, SystemExit) as e:
+                logging.error(f"Failed to process invoice {item[0]}: {e}")
+
+    workers = [threading.Thread(target=work, daemon=True) for _ in range(worker_count)]
+    for worker in workers:
+        worker.start()
+    return workers
+
+
+def _stop_stage(workers: List[threading.Thread], source: queue.Queue) -> None:
+    """Let the workers of a stage finish their queue and wait for them
+
+    args:
+        workers (List[threading.Thread]): Workers of the stage
+        source (queue.Queue): Queue the workers take items from
+    """
+    for _ in workers:
+        source.put(_STOP)
+    for worker in workers:
+        worker.join()
 
 
 def logging_init():
@@ -59,10 +338,13 @@ def logging_init():
     Specifies which file to use for logging and sets color logging
     for better comprehension
     """
+    import coloredlogs
     logging.basicConfig(level=logging.DEBUG)
     coloredlogs.install()
 
 
 if __name__ == "__main__":
     logging_init()
-    main()
+    config.install_reload_handler()
+    with profiling.profile("service_parse", profiling.get_modes()):
+        main()
@@ -1,16 +1,42 @@
 import logging
 import time
-import coloredlogs
 
 import autoparser
 import cache
 import config
+import metrics
 import network
+import profiling
 
 
 def main():
+    try:
+        run()
+        cache.maintain()
+    finally:
+        network.close()
+        textfile_dir = config.get_metrics_config()["textfile_dir"]
+        if textfile_dir:
+            metrics.write_textfile(f"{textfile_dir}/service_zip.prom")
+
+
+def run():
+    """Processes all receipts of open invoices on the payment server once
+
+    Server connections stay open for the next run.
+    """
     open_invoices = cache.get_invoice_numbers()
-    network.download_receipts(config.get_server_config(config.Server.PAYMENT), open_invoices, process_receipt)
+    try:
+        if config.get_async_network_config()["enabled"]:
+            # Imported here, only the async mode needs asyncio
+            import asyncio
+            import async_network
+            asyncio.run(async_network.download_receipts(
+                config.get_server_config(config.Server.PAYMENT), open_invoices, process_receipt_async))
+        else:
+            network.download_receipts(config.get_server_config(config.Server.PAYMENT), open_invoices, process_receipt)
+    finally:
+        cache.commit()
 
 
 def process_receipt(receipt_name: str, receipt: str, invoice_number: str) -> bool:
@@ -29,10 +55,77 @@ def process_receipt(receipt_name: str, receipt: str, invoice_number: str) -> boo
     returns:
         (bool): If receipt got processed successfully
     """
+    mail = prepare_receipt(receipt_name, receipt, invoice_number)
+    if not mail:
+        return False
+
+    # Send mail to client
+    network.send_mail(**mail)
+    logging.info(f"Sent email to '{mail['receiver']}' for invoice '{invoice_number}'")
+    cache.set_state(invoice_number, cache.State.MAILED)
+
+    # Upload file to customer server again
+    network.upload_file(config.get_server_config(config.Server.CUSTOMER), mail["zip_file_name"],
+                        mail["zip_content"])
+    logging.info(f"Uploaded file {mail['zip_file_name']} to {config.get_server_config(config.Server.CUSTOMER).hostname}")
+
+    cache.clear(invoice_number)
+    logging.info(f"Cleared cache files {invoice_number}")
+
+    return True
+
+
+async def process_receipt_async(receipt_name: str, receipt: str, invoice_number: str) -> bool:
+    """Async version of process_receipt
+
+    The email is sent while the ZIP is uploaded to the customer server.
+
+    args:
+        receipt_name (str): Receipt file name
+        receipt (str): Receipt content
+        invoice_number (str): Number of the invoice
+
+    returns:
+        (bool): If receipt got processed successfully
+    """
+    import asyncio
+    import async_network
+
+    mail = await asyncio.get_running_loop().run_in_executor(
+        None, prepare_receipt, receipt_name, receipt, invoice_number)
+    if not mail:
+        return False
+
+    customer_server = config.get_server_config(config.Server.CUSTOMER)
+    await asyncio.gather(
+        async_network.send_mail(**mail),
+        async_network.store_file(customer_server, customer_server.files_in, mail["zip_file_name"],
+                                 mail["zip_content"]))
+    logging.info(f"Sent email to '{mail['receiver']}' for invoice '{invoice_number}'")
+    cache.set_state(invoice_number, cache.State.MAILED)
+
+    cache.clear(invoice_number)
+    logging.info(f"Cleared cache files {invoice_number}")
+
+    return True
+
+
+def prepare_receipt(receipt_name: str, receipt: str, invoice_number: str) -> dict or None:
+    """Caches a receipt and zips it with its invoice
+
+    args:
+        receipt_name (str): Receipt file name
+        receipt (str): Receipt content
+        invoice_number (str): Number of the invoice
+
+    returns:
+        (dict or None): Arguments for network.send_mail or None when the
+                        invoice of the receipt is not cached
+    """
     # Get invoice for receipt and exit if there is none
     invoice_file_name = cache.get_invoice_by_number(invoice_number)
     if not invoice_file_name:
-        return False
+        return None
 
     # Get required data for email
     receipt_date, receipt_time = get_receipt_time_date(receipt_name)
@@ -41,35 +134,32 @@ def process_receipt(receipt_name: str, receipt: str, invoice_number: str) -> boo
             cache.read(invoice_file_name.replace(".txt", ".data")).encode('utf-8'))
     except FileNotFoundError:
         logging.error(f"Failed to get data file for receipt {receipt_name}")
-        return False
+        return None
 
     # Cache current receipt as Kxxx_xxxxx_receipt.txt
     receipt_file_name = invoice_file_name.replace("invoice", "receipt")
     cache.write(receipt_file_name, receipt)
     logging.info(f"Cached file {receipt_file_name}")
+    cache.set_state(invoice_number, cache.State.RECEIPT_RECEIVED)
 
-    # Cache ZIP as Kxxx_xxxxx.zip
+    # Zip invoice and receipt as Kxxx_xxxxx.zip
     zip_file_name = invoice_file_name.replace("_invoice.txt", ".zip")
-    cache.zip_files(invoice_file_name, receipt_file_name, zip_file_name)
-    logging.info(f"Cached file {zip_file_name}")
-
-    # Send mail to client
-    network.send_mail(
-        config.get_email_sender(), config.get_email_sender_name(),
-        receiver, receiver_name,
-        invoice_number, receipt_date,
-        receipt_time, zip_file_name)
-    logging.info(f"Sent email to '{receiver}' for invoice '{invoice_number}'")
-
-    # Upload file to customer server again
-    network.upload_file(config.get_server_config(config.Server.CUSTOMER), zip_file_name,
-                        cache.read_binary(zip_file_name))
-    logging.info(f"Uploaded file {zip_file_name} to {config.get_server_config(config.Server.CUSTOMER).hostname}")
-
-    cache.clear(invoice_number)
-    logging.info(f"Cleared cache files {invoice_number}")
-
-    return True
+    with profiling.span("zip_receipt", invoice=invoice_number):
+        zip_content = cache.zip_files(invoice_file_name, receipt_file_name, zip_file_name,
+                                      contents={receipt_file_name: receipt})
+    logging.info(f"Zipped file {zip_file_name}")
+
+    return {
+        "sender": config.get_email_sender(),
+        "sender_name": config.get_email_sender_name(),
+        "receiver": receiver,
+        "receiver_name": receiver_name,
+        "invoice_number": invoice_number,
+        "receipt_date": receipt_date,
+        "receipt_time": receipt_time,
+        "zip_file_name": zip_file_name,
+        "zip_content": zip_content
+    }
 
 
 def get_receipt_time_date(receipt_name: str):
@@ -102,10 +192,13 @@ def logging_init():
     Specifies which file to use for logging and sets color logging
     for better comprehension
     """
+    import coloredlogs
     logging.basicConfig(level=logging.DEBUG)
     coloredlogs.install()
 
 
 if __name__ == "__main__":
     logging_init()
-    main()
+    config.install_reload_handler()
+    with profiling.profile("service_zip", profiling.get_modes()):
+        main()